@@ -0,0 +1,77 @@
+"""
+Framing and dispatch microbenchmarks
+
+Drives a pair of :class:`quarry.net.connection.Connection` objects directly,
+without a reactor or transport, to measure packet framing, compression,
+encryption and decoding throughput.
+
+Usage: python benchmarks/framing.py [-n NUMBER] [-c COUNT]
+"""
+
+import timeit
+
+from quarry.net.connection import Connection
+
+
+def make_pair(compression_threshold, encrypted):
+    client = Connection("downstream", "upstream", 760)
+    server = Connection("upstream", "downstream", 760)
+    for connection in (client, server):
+        connection.protocol_mode = "play"
+        connection.compression_threshold = compression_threshold
+        if encrypted:
+            connection.cipher.enable(b"0123456789abcdef")
+    return client, server
+
+
+def send(server, payloads):
+    for payload in payloads:
+        server.send_packet("keep_alive", payload)
+    return server.data_to_send()
+
+
+def receive(client, data):
+    client.receive_data(data)
+    count = 0
+    while True:
+        packet = client.next_packet()
+        if packet is None:
+            return count
+        packet[1].discard()
+        count += 1
+
+
+def run(label, stmt, number, count):
+    elapsed = timeit.timeit(stmt, number=number)
+    print("  %-20s %8.2f ms  %10.0f packets/s" % (
+        label, elapsed * 1000, number * count / elapsed))
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", default=20, type=int,
+                        help="iterations per measurement")
+    parser.add_argument("-c", "--count", default=10000, type=int,
+                        help="packets per iteration")
+    args = parser.parse_args(argv)
+
+    for threshold, encrypted in ((-1, False), (256, False), (256, True)):
+        print("compression_threshold=%d encrypted=%s" % (threshold, encrypted))
+        client, server = make_pair(threshold, encrypted)
+        payloads = [server.buff_type.pack("q", i) for i in range(args.count)]
+
+        run("send", lambda: send(server, payloads), args.number, args.count)
+
+        # The cipher is a stream cipher, so each iteration needs fresh data
+        # encrypted in sequence by a fresh pair.
+        client, server = make_pair(threshold, encrypted)
+        chunks = [send(server, payloads) for _ in range(args.number)]
+        chunks.reverse()
+        run("receive", lambda: receive(client, chunks.pop()), args.number,
+            args.count)
+
+
+if __name__ == "__main__":
+    import sys
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+"""
+Varint microbenchmarks
+
+Compares the varint codec in ``quarry.types.buffer`` against the original
+byte-at-a-time implementation, which is reproduced below for reference.
+
+Usage: python benchmarks/varint.py [-n NUMBER]
+"""
+
+import random
+import timeit
+
+from quarry.types.buffer import Buffer
+
+
+class LegacyBuffer(Buffer):
+    @classmethod
+    def pack_varint(cls, number, max_bits=32):
+        number_min = -1 << (max_bits - 1)
+        number_max = +1 << (max_bits - 1)
+        if not (number_min <= number < number_max):
+            raise ValueError("varint does not fit in range")
+
+        if number < 0:
+            number += 1 << 32
+
+        out = b""
+        for i in range(10):
+            b = number & 0x7F
+            number >>= 7
+            out += cls.pack("B", b | (0x80 if number > 0 else 0))
+            if number == 0:
+                break
+        return out
+
+    def unpack_varint(self, max_bits=32):
+        number = 0
+        for i in range(10):
+            b = self.unpack("B")
+            number |= (b & 0x7F) << 7*i
+            if not b & 0x80:
+                break
+
+        if number & (1 << 31):
+            number -= 1 << 32
+
+        number_min = -1 << (max_bits - 1)
+        number_max = +1 << (max_bits - 1)
+        if not (number_min <= number < number_max):
+            raise ValueError("varint does not fit in range")
+
+        return number
+
+    def unpack_varint_array(self, length, max_bits=32):
+        return [self.unpack_varint(max_bits) for _ in range(length)]
+
+    @classmethod
+    def pack_varint_array(cls, array, max_bits=32):
+        return b"".join(cls.pack_varint(x, max_bits) for x in array)
+
+
+def make_values(count):
+    rng = random.Random(0)
+    small = [rng.randrange(0, 128) for _ in range(count // 2)]
+    large = [rng.randrange(-2**31, 2**31) for _ in range(count // 2)]
+    values = small + large
+    rng.shuffle(values)
+    return values
+
+
+def run(label, stmt, number):
+    elapsed = timeit.timeit(stmt, number=number)
+    print("  %-28s %8.2f ms" % (label, elapsed * 1000))
+    return elapsed
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", default=20, type=int,
+                        help="iterations per measurement")
+    args = parser.parse_args(argv)
+
+    values = make_values(4096)
+    palette = list(range(64))
+    data = Buffer.pack_varint_array(values)
+    palette_data = Buffer.pack_varint_array(palette)
+    assert LegacyBuffer.pack_varint_array(values) == data
+
+    for buff_type in (LegacyBuffer, Buffer):
+        print(buff_type.__name__)
+        run("pack_varint (mixed)",
+            lambda: [buff_type.pack_varint(v) for v in values], args.number)
+        run("pack_varint_array (mixed)",
+            lambda: buff_type.pack_varint_array(values), args.number)
+        run("unpack_varint (mixed)",
+            lambda: [b.unpack_varint() for b in [buff_type(data)]
+                     for _ in range(len(values))], args.number)
+        run("unpack_varint_array (mixed)",
+            lambda: buff_type(data).unpack_varint_array(len(values)),
+            args.number)
+        run("unpack_varint_array (palette)",
+            lambda: [buff_type(palette_data).unpack_varint_array(64)
+                     for _ in range(64)], args.number)
+
+
+if __name__ == "__main__":
+    import sys
+    main(sys.argv[1:])
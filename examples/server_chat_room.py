@@ -119,22 +119,25 @@ class ChatRoomFactory(ServerFactory):
         if sender is None:
             sender = UUID(int=0)
 
-        for player in self.players:
-            # 1.19+: Use new system message packet to avoid dealing with signatures
-            if player.protocol_version >= 759:
-                if player.protocol_version >= 760:  # 1.19.1 uses a boolean for whether to show message in action bar
-                    player.send_packet("system_message",
-                                       player.buff_type.pack_chat(message),
-                                       player.buff_type.pack('?', False))
-                else:  # 1.19 uses varint for message location like regular chat
-                    player.send_packet("system_message",
-                                       player.buff_type.pack_chat(message),
-                                       player.buff_type.pack_varint(1))
-            else:
-                player.send_packet("chat_message",
-                                   player.buff_type.pack_chat(message),
-                                   player.buff_type.pack('B', 0),
-                                   player.buff_type.pack_uuid(sender))
+        # 1.19+: Use new system message packet to avoid dealing with signatures
+        def pack_system_message(buff_type, protocol_version):
+            if protocol_version >= 760:  # 1.19.1 uses a boolean for whether to show message in action bar
+                return buff_type.pack_chat(message) + buff_type.pack('?', False)
+            else:  # 1.19 uses varint for message location like regular chat
+                return buff_type.pack_chat(message) + buff_type.pack_varint(1)
+
+        def pack_chat_message(buff_type, protocol_version):
+            return (buff_type.pack_chat(message) +
+                    buff_type.pack('B', 0) +
+                    buff_type.pack_uuid(sender))
+
+        # Each packet is packed and compressed once per protocol version
+        self.broadcast(
+            "system_message", pack_system_message,
+            players=[p for p in self.players if p.protocol_version >= 759])
+        self.broadcast(
+            "chat_message", pack_chat_message,
+            players=[p for p in self.players if p.protocol_version < 759])
 
 
 def main(argv):
@@ -9,6 +9,7 @@ def _load():
     minecraft_versions = {}
     packet_names = {}
     packet_idents = {}
+    packet_tables = {}
     csv_paths = os.path.abspath(os.path.join(
         os.path.dirname(__file__),
         "packets",
@@ -51,11 +52,12 @@ def _load():
                 key = [protocol_version, protocol_mode, packet_direction]
                 packet_names[tuple(key + [packet_ident])] = packet_name
                 packet_idents[tuple(key + [packet_name])] = packet_ident
+                packet_tables.setdefault(tuple(key), []).append(packet_name)
 
                 packet_ident += 1
 
     return (default_protocol_version, minecraft_versions,
-            packet_names, packet_idents)
+            packet_names, packet_idents, packet_tables)
 
 default_protocol_version, minecraft_versions, \
-packet_names, packet_idents = _load()
+packet_names, packet_idents, packet_tables = _load()
@@ -0,0 +1,119 @@
+import bisect
+
+from quarry.types.schema import Schema
+
+
+# Field layouts keyed by (direction, packet name). Each entry lists the
+# protocol versions at which the layout changed, oldest first. Packet names
+# match those in ``packets/*.csv``.
+_definitions = {
+    ("upstream", "handshake"): [
+        (0, [("protocol_version", "varint"),
+             ("connect_host", "string"),
+             ("connect_port", "H"),
+             ("protocol_mode", "varint")]),
+    ],
+    ("upstream", "status_request"): [
+        (0, []),
+    ],
+    ("downstream", "status_response"): [
+        (0, [("data", "json")]),
+    ],
+    ("upstream", "status_ping"): [
+        (0, [("time", "Q")]),
+    ],
+    ("downstream", "status_pong"): [
+        (0, [("time", "Q")]),
+    ],
+    ("downstream", "login_disconnect"): [
+        (0, [("reason", "chat")]),
+    ],
+    ("downstream", "login_set_compression"): [
+        (47, [("threshold", "varint")]),
+    ],
+    ("downstream", "set_compression"): [
+        (47, [("threshold", "varint")]),
+    ],
+    ("downstream", "disconnect"): [
+        (0, [("reason", "chat")]),
+    ],
+    ("downstream", "keep_alive"): [
+        (0, [("keep_alive_id", "i")]),
+        (47, [("keep_alive_id", "varint")]),
+        (340, [("keep_alive_id", "q")]),
+    ],
+    ("upstream", "keep_alive"): [
+        (0, [("keep_alive_id", "i")]),
+        (47, [("keep_alive_id", "varint")]),
+        (340, [("keep_alive_id", "q")]),
+    ],
+    ("downstream", "player_position_and_look"): [
+        (0, [("x", "d"), ("y", "d"), ("z", "d"),
+             ("yaw", "f"), ("pitch", "f"),
+             ("on_ground", "?")]),
+        (47, [("x", "d"), ("y", "d"), ("z", "d"),
+              ("yaw", "f"), ("pitch", "f"),
+              ("flags", "B")]),
+        (107, [("x", "d"), ("y", "d"), ("z", "d"),
+               ("yaw", "f"), ("pitch", "f"),
+               ("flags", "B"),
+               ("teleport_id", "varint")]),
+        (755, [("x", "d"), ("y", "d"), ("z", "d"),
+               ("yaw", "f"), ("pitch", "f"),
+               ("flags", "B"),
+               ("teleport_id", "varint"),
+               ("dismount_vehicle", "?")]),
+    ],
+    ("upstream", "player_position_and_look"): [
+        (0, [("x", "d"), ("y", "d"), ("head_y", "d"), ("z", "d"),
+             ("yaw", "f"), ("pitch", "f"),
+             ("on_ground", "?")]),
+        (47, [("x", "d"), ("y", "d"), ("z", "d"),
+              ("yaw", "f"), ("pitch", "f"),
+              ("on_ground", "?")]),
+    ],
+    ("upstream", "player"): [
+        (0, [("on_ground", "?")]),
+    ],
+    ("upstream", "teleport_confirm"): [
+        (107, [("teleport_id", "varint")]),
+    ],
+}
+
+
+def _load():
+    schemas = {}
+    for (direction, name), layouts in _definitions.items():
+        versions = []
+        entries = []
+        for protocol_version, fields in layouts:
+            versions.append(protocol_version)
+            entries.append(Schema(name, fields))
+        schemas[direction, name] = (versions, entries)
+    return schemas
+
+
+schemas = _load()
+_lookup_cache = {}
+
+
+def get_schema(protocol_version, direction, name):
+    """
+    Returns the :class:`~quarry.types.schema.Schema` describing the given
+    packet in the given protocol version. Raises ``KeyError`` if no schema is
+    known.
+    """
+
+    key = (protocol_version, direction, name)
+    try:
+        return _lookup_cache[key]
+    except KeyError:
+        pass
+
+    versions, entries = schemas[direction, name]
+    idx = bisect.bisect_right(versions, protocol_version) - 1
+    if idx < 0:
+        raise KeyError(key)
+
+    _lookup_cache[key] = entries[idx]
+    return entries[idx]
@@ -0,0 +1,262 @@
+"""
+Runs quarry's protocols on an asyncio event loop rather than the Twisted
+reactor. Packet framing, encryption, dispatch and the login state machine are
+shared with the Twisted implementation; only the transport, timers and thread
+pool are swapped out.
+
+Session server requests made in online mode still use Twisted's HTTP client.
+They work when Twisted's asyncio reactor is installed on the same loop.
+"""
+
+import asyncio
+import functools
+import weakref
+
+from twisted.internet import defer, error
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.python import failure
+
+from quarry.net.client import ClientFactory, PingClientFactory
+from quarry.net.server import ServerFactory
+from quarry.net.ticker import Ticker
+
+
+class DelayedCall(object):
+    """
+    Wraps an asyncio timer handle in the interface of Twisted's
+    ``IDelayedCall``.
+    """
+
+    _handle = None
+    _called = False
+
+    def _run(self, f, args, kwargs):
+        self._called = True
+        f(*args, **kwargs)
+
+    def getTime(self):
+        return self._handle.when()
+
+    def cancel(self):
+        if not self.active():
+            raise error.AlreadyCancelled()
+        self._handle.cancel()
+
+    def active(self):
+        return not (self._called or self._handle.cancelled())
+
+
+class LoopClock(object):
+    """
+    Provides the ``callLater()`` and ``seconds()`` methods of Twisted's
+    ``IReactorTime`` using an asyncio event loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, f, *args, **kwargs):
+        call = DelayedCall()
+        call._handle = self.loop.call_later(
+            max(delay, 0), call._run, f, args, kwargs)
+        return call
+
+
+_clocks = weakref.WeakKeyDictionary()
+
+
+def get_loop_clock(loop=None):
+    """
+    Returns the :class:`LoopClock` for the given loop, or for the running
+    loop if none is given.
+    """
+
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    clock = getattr(loop, "_quarry_clock", None)
+    if clock is None:
+        try:
+            clock = loop._quarry_clock = LoopClock(loop)
+        except AttributeError:
+            # Loops that don't accept attributes get a clock that refers
+            # back to them weakly, so the loop can still be released.
+            clock = _clocks.get(loop)
+            if clock is None:
+                clock = _clocks[loop] = LoopClock(weakref.proxy(loop))
+    return clock
+
+
+class AsyncioTicker(Ticker):
+    """
+    A ticker driven by ``loop.call_later()`` on the running asyncio loop.
+    Tickers on the same loop share a scheduler.
+    """
+
+    @classmethod
+    def get_clock(cls):
+        return get_loop_clock()
+
+
+class Connector(object):
+    def __init__(self, destination):
+        self._destination = destination
+
+    def getDestination(self):
+        return self._destination
+
+
+class Transport(object):
+    """
+    Wraps an asyncio transport in the subset of Twisted's ``ITransport`` and
+    ``IPushProducer`` interfaces used by quarry's protocols.
+    """
+
+    connector = None
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def write(self, data):
+        self._transport.write(data)
+
+    def writeSequence(self, data):
+        self._transport.writelines(data)
+
+    def loseConnection(self):
+        self._transport.close()
+
+    def abortConnection(self):
+        self._transport.abort()
+
+    def pauseProducing(self):
+        self._transport.pause_reading()
+
+    def resumeProducing(self):
+        self._transport.resume_reading()
+
+    def stopProducing(self):
+        self._transport.close()
+
+    def getPeer(self):
+        return make_address(self._transport.get_extra_info("peername"))
+
+    def getHost(self):
+        return make_address(self._transport.get_extra_info("sockname"))
+
+
+def make_address(sockaddr):
+    """
+    Converts a socket address to a Twisted address object.
+    """
+
+    host, port = sockaddr[:2]
+    if ":" in host:
+        return IPv6Address("TCP", host, port)
+    return IPv4Address("TCP", host, port)
+
+
+class AsyncioProtocol(asyncio.Protocol):
+    """
+    Passes events from an asyncio transport to a quarry protocol, which is
+    built by the factory once the connection is made.
+    """
+
+    protocol = None
+
+    def __init__(self, factory, destination=None):
+        self.factory = factory
+        self.destination = destination
+
+    def connection_made(self, transport):
+        adapter = Transport(transport)
+        if self.destination is not None:
+            adapter.connector = Connector(self.destination)
+
+        self.protocol = self.factory.buildProtocol(adapter.getPeer())
+        if self.protocol is None:
+            transport.close()
+            return
+        self.protocol.makeConnection(adapter)
+
+    def data_received(self, data):
+        if self.protocol is not None:
+            self.protocol.dataReceived(data)
+
+    def connection_lost(self, exc):
+        if self.protocol is not None:
+            if exc is None:
+                reason = failure.Failure(error.ConnectionDone())
+            else:
+                reason = failure.Failure(error.ConnectionLost(str(exc)))
+            self.protocol.connectionLost(reason)
+            self.protocol = None
+
+
+class AsyncioFactoryMixin(object):
+    """
+    Overrides the reactor-specific parts of a quarry factory to use the
+    running asyncio loop.
+    """
+
+    ticker_type = AsyncioTicker
+
+    #: Executor used by :meth:`defer_to_thread`, or ``None`` for the loop's
+    #: default executor.
+    executor = None
+
+    @property
+    def clock(self):
+        return get_loop_clock()
+
+    def defer_to_thread(self, f, *args, **kwargs):
+        return self.defer_to_executor(self.executor, f, *args, **kwargs)
+
+    def defer_to_executor(self, executor, f, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return defer.Deferred.fromFuture(loop.run_in_executor(
+            executor, functools.partial(f, *args, **kwargs)))
+
+
+class AsyncioServerFactory(AsyncioFactoryMixin, ServerFactory):
+    """
+    A :class:`~quarry.net.server.ServerFactory` that listens using asyncio.
+    """
+
+    async def listen(self, host, port=25565):
+        """
+        Starts listening for connections, returning an ``asyncio.Server``.
+        """
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            functools.partial(AsyncioProtocol, self), host, port)
+        self.doStart()
+        return server
+
+
+class AsyncioClientFactory(AsyncioFactoryMixin, ClientFactory):
+    """
+    A :class:`~quarry.net.client.ClientFactory` that connects using asyncio.
+    """
+
+    def connect(self, host, port=25565):
+        """
+        Starts connecting to a server, returning an ``asyncio.Task`` that
+        completes with the ``(transport, protocol)`` pair once connected.
+        """
+        loop = asyncio.get_running_loop()
+        destination = IPv4Address("TCP", host, port)
+        return loop.create_task(asyncio.wait_for(
+            loop.create_connection(
+                functools.partial(AsyncioProtocol, self, destination),
+                host, port),
+            self.connection_timeout))
+
+    def make_ping_factory(self):
+        return AsyncioPingClientFactory()
+
+
+class AsyncioPingClientFactory(AsyncioClientFactory, PingClientFactory):
+    pass
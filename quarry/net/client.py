@@ -21,13 +21,13 @@ class ClientProtocol(Protocol):
         if mode in ("status", "login"):
             # Send handshake
             addr = self.transport.connector.getDestination()
-            self.send_packet(
+            self.send_packet("handshake", self.pack_fields(
                 "handshake",
-                self.buff_type.pack_varint(self.protocol_version) +
-                self.buff_type.pack_string(addr.host) +
-                self.buff_type.pack('H', addr.port) +
-                self.buff_type.pack_varint(
-                    protocol_modes_inv[self.factory.protocol_mode_next]))
+                protocol_version=self.protocol_version,
+                connect_host=addr.host,
+                connect_port=addr.port,
+                protocol_mode=protocol_modes_inv[
+                    self.factory.protocol_mode_next]))
 
             # Switch buff type
             self.buff_type = self.factory.get_buff_type(self.protocol_version)
@@ -68,7 +68,7 @@ class ClientProtocol(Protocol):
         elif self.factory.force_protocol_version is not None:
             self.protocol_version = self.factory.force_protocol_version
         else:
-            factory = PingClientFactory()
+            factory = self.factory.make_ping_factory()
             factory.connect(self.remote_addr.host, self.remote_addr.port)
             self.protocol_version = yield factory.detected_protocol_version
 
@@ -203,10 +203,12 @@ class ClientProtocol(Protocol):
         self.player_joined()
 
     def packet_login_set_compression(self, buff):
-        self.set_compression(buff.unpack_varint())
+        p = self.unpack_fields(buff, "login_set_compression")
+        self.set_compression(p.threshold)
 
     def packet_set_compression(self, buff):
-        self.set_compression(buff.unpack_varint())
+        p = self.unpack_fields(buff, "set_compression")
+        self.set_compression(p.threshold)
 
     packet_disconnect = packet_login_disconnect
 
@@ -238,30 +240,21 @@ class SpawningClientProtocol(ClientProtocol):
                 True))
 
     def packet_player_position_and_look(self, buff):
-        p_pos_look = buff.unpack('dddff')
+        p = self.unpack_fields(buff, "player_position_and_look")
+        p_pos_look = (p.x, p.y, p.z, p.yaw, p.pitch)
 
         # 1.7.x
         if self.protocol_version <= 5:
-            p_on_ground = buff.unpack('?')
-            self.pos_look = p_pos_look
+            self.pos_look = list(p_pos_look)
 
         # 1.8.x
         else:
-            p_flags = buff.unpack('B')
-
             for i in range(5):
-                if p_flags & (1 << i):
+                if p.flags & (1 << i):
                     self.pos_look[i] += p_pos_look[i]
                 else:
                     self.pos_look[i] = p_pos_look[i]
 
-            # 1.9.x
-            if self.protocol_version > 47:
-                teleport_id = buff.unpack_varint()
-
-            if self.protocol_version > 754:
-                dismount_vehicle = buff.unpack('?')
-
         # Send Player Position And Look
 
         # 1.7.x
@@ -289,8 +282,8 @@ class SpawningClientProtocol(ClientProtocol):
 
         # 1.9.x
         else:
-            self.send_packet("teleport_confirm", self.buff_type.pack_varint(
-                teleport_id))
+            self.send_packet("teleport_confirm", self.pack_fields(
+                "teleport_confirm", teleport_id=p.teleport_id))
 
         if not self.spawned:
             self.spawn()
@@ -316,6 +309,13 @@ class ClientFactory(Factory, protocol.ClientFactory):
     def connect(self, host, port=25565):
         reactor.connectTCP(host, port, self, self.connection_timeout)
 
+    def make_ping_factory(self):
+        """
+        Returns a factory used to detect the server's protocol version when
+        ``force_protocol_version`` is not set.
+        """
+        return PingClientFactory()
+
 
 class PingClientProtocol(ClientProtocol):
 
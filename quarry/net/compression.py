@@ -0,0 +1,111 @@
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+
+class AdaptiveCompression(object):
+    """
+    Trades bandwidth for CPU time under load. Lag is sampled periodically,
+    as the greater of the reactor's lag and the mean tick duration recorded
+    in the factory's :meth:`~quarry.net.protocol.Factory.get_tick_stats`
+    since the last sample. While it exceeds :attr:`budget`, compression is
+    reduced one step at a time, first by capping the compression level and
+    then by raising the compression threshold offered to newly joining
+    players. Once lag stays low, the factory's settings are restored one
+    step at a time. If compression is disabled, only the level is capped.
+    """
+
+    #: Interval between samples, in seconds
+    interval = 1.0
+
+    #: Lag, in seconds, above which compression is reduced
+    budget = 0.05
+
+    #: Number of consecutive samples under half the budget before a step of
+    #: reduction is undone
+    recover_samples = 5
+
+    #: Compression level caps to step through, most costly first
+    levels = (4, 1)
+
+    #: Highest compression threshold to step up to
+    max_threshold = 4096
+
+    #: Current step; 0 means no reduction
+    step = 0
+
+    running = False
+
+    def __init__(self, factory, clock=reactor):
+        self.factory = factory
+        self.clock = clock
+        self.base_threshold = factory.compression_threshold
+        self.steps = self._make_steps()
+        self.stats = factory.get_tick_stats()
+        self._ticks = self.stats.ticks
+        self._calm = 0
+        self._last = None
+        self._impl = LoopingCall(self._sample)
+        self._impl.clock = clock
+
+    def start(self):
+        """
+        Start sampling reactor lag.
+        """
+        if not self.running:
+            self._last = self.clock.seconds()
+            self._ticks = self.stats.ticks
+            self._impl.start(self.interval, now=False)
+            self.running = True
+
+    def stop(self):
+        """
+        Stop sampling reactor lag and restore the factory's settings.
+        """
+        if self.running:
+            self._impl.stop()
+            self.running = False
+        self._apply(0)
+
+    def _make_steps(self):
+        steps = [(None, self.base_threshold)]
+        for level in self.levels:
+            steps.append((level, self.base_threshold))
+
+        # A threshold of 0 or below leaves compression off for new players
+        threshold = self.base_threshold
+        if threshold and threshold > 0:
+            while threshold < self.max_threshold:
+                threshold = min(max(threshold * 2, 64), self.max_threshold)
+                steps.append((steps[-1][0], threshold))
+        return steps
+
+    def _get_tick_lag(self):
+        # Mean duration of the ticks recorded since the last sample
+        stats = self.stats
+        count = min(stats.ticks - self._ticks, len(stats.durations))
+        self._ticks = stats.ticks
+        if count <= 0:
+            return 0.0
+        durations = list(stats.durations)[-count:]
+        return sum(durations) / count
+
+    def _sample(self):
+        now = self.clock.seconds()
+        lag = max(now - self._last - self.interval, self._get_tick_lag())
+        self._last = now
+
+        if lag > self.budget:
+            self._calm = 0
+            if self.step + 1 < len(self.steps):
+                self._apply(self.step + 1)
+        elif lag < self.budget / 2 and self.step > 0:
+            self._calm += 1
+            if self._calm >= self.recover_samples:
+                self._calm = 0
+                self._apply(self.step - 1)
+
+    def _apply(self, step):
+        self.step = step
+        level_cap, threshold = self.steps[step]
+        self.factory.compression_level_cap = level_cap
+        self.factory.compression_threshold = threshold
@@ -0,0 +1,314 @@
+import zlib
+
+from quarry.data import packets, schemas
+from quarry.types.buffer import BufferUnderrun, BufferLimitExceeded, \
+    buff_types
+from quarry.net.crypto import Cipher
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def get_buff_type(protocol_version):
+    """
+    Gets a buffer type for the given protocol version.
+    """
+    for ver, cls in reversed(buff_types):
+        if protocol_version >= ver:
+            return cls
+
+
+class Connection(object):
+    """
+    The state of one side of a connection, without any I/O. Bytes received
+    from the remote are passed to :meth:`receive_data`, and decoded packets
+    are taken from :meth:`next_packet`. Packets passed to
+    :meth:`send_packet` are framed, compressed and encrypted, and the bytes
+    to write are taken from :meth:`data_to_send`.
+
+    :class:`~quarry.net.protocol.Protocol` wraps a connection for use with
+    Twisted; it may also be driven directly, e.g. from a custom I/O loop or
+    a benchmark.
+    """
+
+    #: Either ``"upstream"`` (packets to the server) or ``"downstream"``
+    recv_direction = None
+
+    #: Either ``"upstream"`` or ``"downstream"``
+    send_direction = None
+
+    #: Protocol version used to look up packet IDs and schemas
+    protocol_version = packets.default_protocol_version
+
+    #: One of ``"init"``, ``"status"``, ``"login"`` or ``"play"``
+    protocol_mode = "init"
+
+    #: Size in bytes at which packets are compressed, or -1 if compression
+    #: is disabled
+    compression_threshold = -1
+
+    #: If true, received packets are decompressed lazily. See
+    #: :attr:`Factory.lazy_decompression
+    #: <quarry.net.protocol.Factory.lazy_decompression>`.
+    lazy_decompression = False
+
+    #: zlib compression strategy for outgoing packets.
+    compression_strategy = zlib.Z_DEFAULT_STRATEGY
+
+    #: Limits applied to :attr:`recv_buff`. See
+    #: :attr:`Factory.max_frame_size
+    #: <quarry.net.protocol.Factory.max_frame_size>` and the following
+    #: attributes.
+    max_frame_size = None
+    max_uncompressed_size = None
+    max_array_length = None
+
+    # Packet names indexed by ID, for the current version and mode
+    _recv_table = ()
+    _recv_table_key = None
+
+    def __init__(self, recv_direction, send_direction,
+                 protocol_version=None, buff_type=None):
+        self.recv_direction = recv_direction
+        self.send_direction = send_direction
+        if protocol_version is not None:
+            self.protocol_version = protocol_version
+        if buff_type is None:
+            buff_type = get_buff_type(self.protocol_version)
+
+        #: A :class:`~quarry.types.buffer.Buffer` class for this protocol
+        #: version
+        self.buff_type = buff_type
+
+        self._recv_buff = None
+        self._cipher = None
+        self._outgoing = []
+        self._outgoing_size = 0
+
+    @property
+    def recv_buff(self):
+        """
+        Buffer of received bytes, after decryption. Created when first used.
+        """
+        if self._recv_buff is None:
+            recv_buff = self._recv_buff = self.buff_type()
+            recv_buff.max_frame_size = self.max_frame_size
+            recv_buff.max_uncompressed_size = self.max_uncompressed_size
+            recv_buff.max_array_length = self.max_array_length
+        return self._recv_buff
+
+    @recv_buff.setter
+    def recv_buff(self, recv_buff):
+        self._recv_buff = recv_buff
+
+    @property
+    def cipher(self):
+        """
+        A :class:`~quarry.net.crypto.Cipher` applied to all data. Created
+        when first used, as most connections are never encrypted.
+        """
+        if self._cipher is None:
+            self._cipher = Cipher()
+        return self._cipher
+
+    @cipher.setter
+    def cipher(self, cipher):
+        self._cipher = cipher
+
+    # Packet IDs --------------------------------------------------------------
+
+    def get_packet_name(self, ident):
+        table_key = (self.protocol_version, self.protocol_mode)
+        if table_key != self._recv_table_key:
+            self._recv_table = packets.packet_tables.get(
+                table_key + (self.recv_direction,), ())
+            self._recv_table_key = table_key
+
+        if 0 <= ident < len(self._recv_table):
+            return self._recv_table[ident]
+
+        key = table_key + (self.recv_direction, ident)
+        raise ProtocolError("No name known for packet: %s" % (key,))
+
+    def get_packet_ident(self, name):
+        key = (self.protocol_version, self.protocol_mode, self.send_direction,
+               name)
+        try:
+            return packets.packet_idents[key]
+        except KeyError:
+            raise ProtocolError("No ID known for packet: %s" % (key,))
+
+    def get_compression_level(self, name):
+        """
+        Gets the compression level to use for the named packet. Returns -1
+        (zlib's default) unless overridden.
+        """
+        return -1
+
+    # Schemas -----------------------------------------------------------------
+
+    def unpack_fields(self, buff, name):
+        """
+        Unpacks the payload of a received packet according to its schema.
+        Returns a :class:`~quarry.types.schema.Packet` with one attribute per
+        field.
+        """
+
+        key = (self.protocol_version, self.recv_direction, name)
+        try:
+            schema = schemas.get_schema(*key)
+        except KeyError:
+            raise ProtocolError("No schema known for packet: %s" % (key,))
+        return schema.compile(self.buff_type).from_buff(buff)
+
+    def pack_fields(self, name, **fields):
+        """
+        Packs the payload of a packet to be sent according to its schema.
+        Fields are given as keyword arguments.
+        """
+
+        key = (self.protocol_version, self.send_direction, name)
+        try:
+            schema = schemas.get_schema(*key)
+        except KeyError:
+            raise ProtocolError("No schema known for packet: %s" % (key,))
+        return schema.compile(self.buff_type)(**fields).to_bytes()
+
+    # Receiving ---------------------------------------------------------------
+
+    def receive_data(self, data):
+        """
+        Decrypts and buffers bytes received from the remote.
+        """
+
+        if self._cipher is not None:
+            data = self._cipher.decrypt(data)
+        self.recv_buff.add(data)
+
+    def next_packet(self):
+        """
+        Returns the next received packet as a ``(name, buff)`` tuple, or
+        ``None`` if no complete packet has been received. Raises
+        :class:`ProtocolError` if a packet can't be decoded.
+
+        Changes to the protocol mode or compression threshold take effect
+        from the following packet.
+        """
+
+        frame = self.next_frame()
+        if frame is None:
+            return None
+        ident, buff = frame
+        return self.get_packet_name(ident), buff
+
+    def next_frame(self):
+        """
+        Like :meth:`next_packet`, but returns an ``(ident, buff)`` tuple
+        without looking up the packet's name.
+        """
+
+        recv_buff = self.recv_buff
+
+        # Save the buffer, in case we read an incomplete packet
+        recv_buff.save()
+
+        try:
+            buff = recv_buff.unpack_packet(
+                self.buff_type,
+                self.compression_threshold,
+                self.lazy_decompression)
+        except BufferUnderrun:
+            recv_buff.restore()
+            return None
+        except BufferLimitExceeded as e:
+            raise ProtocolError(str(e))
+
+        try:
+            ident = buff.unpack_varint()
+        except BufferUnderrun:
+            raise ProtocolError("Packet is empty")
+
+        return ident, buff
+
+    # Sending -----------------------------------------------------------------
+
+    def pack_frame(self, name, *data):
+        """
+        Packs a packet frame, applying this connection's packet IDs and
+        compression but not its encryption.
+        """
+
+        data = b"".join(data)
+
+        # Prepend ident
+        data = self.buff_type.pack_varint(self.get_packet_ident(name)) + data
+
+        # Pack packet
+        if self.compression_threshold < 0:
+            return self.buff_type.pack_packet(data)
+        return self.buff_type.pack_packet(
+            data,
+            self.compression_threshold,
+            self.get_compression_level(name),
+            self.compression_strategy)
+
+    def send_packet(self, name, *data):
+        """
+        Queues a packet to be sent.
+        """
+
+        self.send_frame(self.pack_frame(name, *data))
+
+    def send_frame(self, data):
+        """
+        Queues a frame produced by :meth:`pack_frame` to be sent.
+        """
+
+        self._outgoing.append(data)
+        self._outgoing_size += len(data)
+
+    @property
+    def outgoing_size(self):
+        """
+        Number of bytes queued to be sent, before encryption.
+        """
+        return self._outgoing_size
+
+    def data_to_send(self):
+        """
+        Returns all queued bytes, encrypted, and clears the queue. Returns
+        ``b""`` if nothing is queued.
+        """
+
+        outgoing = self._outgoing
+        if not outgoing:
+            return b""
+
+        self._outgoing = []
+        self._outgoing_size = 0
+
+        if len(outgoing) == 1:
+            data = outgoing[0]
+        else:
+            data = b"".join(outgoing)
+        if self._cipher is not None:
+            data = self._cipher.encrypt(data)
+        return data
+
+    def frames_to_send(self):
+        """
+        Like :meth:`data_to_send`, but returns a list of byte strings to be
+        written in order, e.g. with ``writeSequence()``. Frames aren't joined
+        unless they need encrypting.
+        """
+
+        cipher = self._cipher
+        if cipher is not None and cipher.encryptor:
+            data = self.data_to_send()
+            return [data] if data else []
+
+        outgoing = self._outgoing
+        self._outgoing = []
+        self._outgoing_size = 0
+        return outgoing
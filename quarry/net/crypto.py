@@ -1,7 +1,10 @@
 import base64
+import collections
 import os
 import sys
 import hashlib
+import threading
+import time
 
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import ciphers, serialization
@@ -125,30 +128,122 @@ def get_yggdrasil_session_key():
     return _yggdrasil_key
 
 
+class VerifiedKeyCache(object):
+    """
+    A bounded cache of profile public keys whose Mojang signatures have been
+    verified, so that players who reconnect with the same key skip the RSA
+    check. Entries are keyed by ``(uuid, expiry, signature)`` and hold the
+    key's DER bytes, which must also match for a lookup to succeed. Entries
+    are dropped once their key expires, and the least recently used entry is
+    dropped when the cache is full. Safe to use from several threads.
+    """
+
+    #: Maximum number of keys held
+    max_size = 4096
+
+    def __init__(self, max_size=None):
+        if max_size is not None:
+            self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def contains(self, uuid, data, key_bytes, now=None):
+        """
+        Returns ``True`` if the given key has been verified and hasn't
+        expired. ``now`` is in milliseconds since the epoch, like
+        :attr:`PlayerPublicKey.expiry <quarry.net.auth.PlayerPublicKey>`.
+        """
+
+        if now is None:
+            now = time.time() * 1000
+        cache_key = (uuid, data.expiry, data.signature)
+        with self.lock:
+            cached = self.entries.get(cache_key)
+            if cached is None:
+                return False
+            if data.expiry < now:
+                del self.entries[cache_key]
+                return False
+            if cached != key_bytes:
+                return False
+            self.entries.move_to_end(cache_key)
+            return True
+
+    def add(self, uuid, data, key_bytes, now=None):
+        """
+        Records that the given key has been verified.
+        """
+
+        if now is None:
+            now = time.time() * 1000
+        if data.expiry < now:
+            return
+        cache_key = (uuid, data.expiry, data.signature)
+        with self.lock:
+            self.entries[cache_key] = key_bytes
+            self.entries.move_to_end(cache_key)
+            if len(self.entries) > self.max_size:
+                self.evict(now)
+
+    def evict(self, now):
+        # Drop expired keys first, then the least recently used
+        expired = [k for k in self.entries if k[1] < now]
+        for cache_key in expired:
+            del self.entries[cache_key]
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+#: Cache of verified profile public keys
+verified_keys = VerifiedKeyCache()
+
+
 # Verify 1.19 signature
 def verify_mojang_v1_signature(data: PlayerPublicKey):
+    key_bytes = data.key.public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+    if verified_keys.contains(None, data, key_bytes):
+        return True
+
     # Need key in PEM format
-    key_text = base64.encodebytes(data.key.public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)).decode('ISO-8859-1')
+    key_text = base64.encodebytes(key_bytes).decode('ISO-8859-1')
     e = "-----BEGIN RSA PUBLIC KEY-----\n" + key_text + "-----END RSA PUBLIC KEY-----\n"
 
     try:
         # Signature is timestamp as string + public key in PEM format
         get_yggdrasil_session_key().verify(data.signature, bytes(str(data.expiry) + e, 'ascii'), PKCS1v15(), SHA1())
-        return True
     except InvalidSignature:
         return False
 
+    verified_keys.add(None, data, key_bytes)
+    return True
+
 
 # Verify 1.19.1+ signature
 def verify_mojang_v2_signature(data: PlayerPublicKey, uuid):
     if uuid is None:
         return False
 
+    key_bytes = data.key.public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+    if verified_keys.contains(uuid, data, key_bytes):
+        return True
+
     try:
         # Signature is uuid bytes + timestamp bytes + public key bytes
-        key_bytes = data.key.public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
         get_yggdrasil_session_key()\
             .verify(data.signature, uuid.bytes + data.expiry.to_bytes(8, 'big') + key_bytes, PKCS1v15(), SHA1())
-        return True
     except InvalidSignature:
         return False
+
+    verified_keys.add(uuid, data, key_bytes)
+    return True
@@ -1,9 +1,12 @@
+import copy
 import json
+from urllib.parse import urlsplit
 
 from twisted.internet import defer, reactor
 from twisted.internet.defer import succeed
 from twisted.python import failure
-from twisted.web.client import Agent, error, Response, readBody
+from twisted.web.client import Agent, HTTPConnectionPool, error, Response, \
+    readBody
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 from zope.interface import implementer
@@ -35,48 +38,143 @@ class BytesProducer:
         pass
 
 
-def request(url, timeout, err_type=Exception, expect_content=False, data=None):
-    d0 = defer.Deferred()
+class HTTPClient(object):
+    """
+    Makes JSON requests to Mojang's web APIs. Connections are kept alive in a
+    shared pool, so repeated requests to the session server skip the TCP and
+    TLS handshakes. Identical requests made while one is in flight share its
+    response.
+    """
+
+    #: Maximum number of concurrent connections to each host. Further
+    #: requests wait for a connection to become free.
+    max_connections_per_host = 8
+
+    #: Maximum number of idle connections kept alive to each host
+    max_persistent_per_host = 4
+
+    #: Seconds after which idle connections are closed
+    cached_connection_timeout = 240
+
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self.pool = HTTPConnectionPool(clock, persistent=True)
+        self.pool.maxPersistentPerHost = self.max_persistent_per_host
+        self.pool.cachedConnectionTimeout = self.cached_connection_timeout
+        self.agent = Agent(clock, pool=self.pool)
+        self.semaphores = {}
+        self.in_flight = {}
+
+    def request(self, url, timeout, err_type=Exception, expect_content=False,
+                data=None):
+        """
+        Requests the given URL, with a POST if ``data`` is given or a GET
+        otherwise. Returns a deferred that fires with the decoded JSON
+        response, or ``None`` if the response is empty. Fails with
+        ``err_type`` if the server reports an error or doesn't respond
+        within ``timeout`` seconds.
+        """
+
+        if data:
+            body = json.dumps(data).encode('ascii')
+        else:
+            body = None
+
+        key = (url, body, err_type, expect_content)
+        waiters = self.in_flight.get(key)
+        if waiters is None:
+            waiters = self.in_flight[key] = []
+            d1 = self._request(url, body, timeout, err_type, expect_content)
+            d1.addBoth(self._request_done, key)
+
+        d0 = defer.Deferred()
+        waiters.append(d0)
+        return d0
+
+    def close(self):
+        """
+        Closes idle connections. Returns a deferred.
+        """
+        return self.pool.closeCachedConnections()
+
+    def _request_done(self, result, key):
+        waiters = self.in_flight.pop(key)
+        if isinstance(result, failure.Failure):
+            for d in waiters:
+                d.errback(result)
+        else:
+            # Each waiter gets its own copy of the decoded response, made
+            # before any callbacks run, so one can't modify what another sees
+            results = [result] + [copy.deepcopy(result) for _ in waiters[1:]]
+            for d, result in zip(waiters, results):
+                d.callback(result)
+
+    def _request(self, url, body, timeout, err_type, expect_content):
+        def _send():
+            if body:
+                d = self.agent.request(
+                    b'POST',
+                    url,
+                    Headers({"Content-Type": ["application/json"]}),
+                    BytesProducer(body),
+                )
+            else:
+                d = self.agent.request(b'GET', url)
+            d.addCallback(readBody)
+            return d
 
-    def _callback(response):
-        def _callback2(body):
+        def _callback(body):
             if len(body):
-                d0.callback(json.loads(body.decode('ascii')))
+                return json.loads(body.decode('ascii'))
             else:
-                d0.callback(None)
-        d = readBody(response)
-        d.addCallback(_callback2)
+                return None
+
+        def _errback(err):
+            if err.check(defer.TimeoutError):
+                return failure.Failure(err_type(
+                    "Timeout",
+                    "No response was received within %s seconds" % timeout))
+            if isinstance(err.value, error.Error):
+                if err.value.status == b"204":
+                    if expect_content:
+                        return failure.Failure(err_type(
+                            "No Content",
+                            "No content was returned by the server"))
+                    else:
+                        return None
+                else:
+                    data = json.loads(err.value.response.decode('ascii'))
+                    return failure.Failure(err_type(
+                        data['error'],
+                        data['errorMessage']))
+            return err
+
+        host = urlsplit(url).netloc
+        semaphore = self.semaphores.get(host)
+        if semaphore is None:
+            semaphore = self.semaphores[host] = defer.DeferredSemaphore(
+                self.max_connections_per_host)
+
+        d = semaphore.run(_send)
+        d.addTimeout(timeout, self.clock)
+        d.addCallbacks(_callback, _errback)
         return d
 
-    def _errback(err):
-        if isinstance(err.value, error.Error):
-            if err.value.status == b"204":
-                if expect_content:
-                    err = failure.Failure(err_type(
-                        "No Content",
-                        "No content was returned by the server"))
-                else:
-                    d0.callback(None)
-                    return
-            else:
-                data = json.loads(err.value.response.decode('ascii'))
-                err = failure.Failure(err_type(
-                    data['error'],
-                    data['errorMessage']))
-        d0.errback(err)
-
-    agent = Agent(reactor)
-
-    if data:
-        d1 = agent.request(
-            b'POST',
-            url,
-            Headers({"Content-Type": ["application/json"]}),
-            BytesProducer(json.dumps(data).encode('ascii')),
-        )
-    else:
-        d1 = agent.request(b'GET', url)
-
-    d1.addCallbacks(_callback, _errback)
-
-    return d0
+
+_client = None
+
+
+def get_client():
+    """
+    Returns the shared :class:`HTTPClient`.
+    """
+
+    global _client
+    if _client is None:
+        _client = HTTPClient()
+        reactor.addSystemEventTrigger("before", "shutdown", _client.close)
+    return _client
+
+
+def request(url, timeout, err_type=Exception, expect_content=False, data=None):
+    return get_client().request(url, timeout, err_type, expect_content, data)
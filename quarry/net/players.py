@@ -0,0 +1,244 @@
+import math
+
+from quarry.net.protocol import Protocol
+
+
+class PlayerIndex(object):
+    """
+    Indexes the players in a game by UUID, by display name and by group.
+    Groups are hashable tags chosen by the application, such as a team,
+    party or world name, and a player may be in any number of them.
+
+    :class:`~quarry.net.server.ServerFactory` keeps an instance as
+    ``player_index``, and adds players when they join and removes them when
+    their connection is lost.
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._by_uuid = {}
+        self._by_name = {}
+        self._groups = {}
+        self._player_groups = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, player):
+        return player in self._keys
+
+    def add(self, player):
+        """
+        Adds a player, replacing any player with the same UUID or name.
+        """
+        self._remove_keys(player)
+        uuid = player.uuid
+        name = player.display_name.lower()
+        self._keys[player] = (uuid, name)
+        self._by_uuid[uuid] = player
+        self._by_name[name] = player
+
+    def remove(self, player):
+        """
+        Removes a player from the index and from all its groups.
+        """
+        self._remove_keys(player)
+        for group in self._player_groups.pop(player, ()):
+            members = self._groups[group]
+            members.discard(player)
+            if not members:
+                del self._groups[group]
+
+    def _remove_keys(self, player):
+        keys = self._keys.pop(player, None)
+        if keys is not None:
+            uuid, name = keys
+            if self._by_uuid.get(uuid) is player:
+                del self._by_uuid[uuid]
+            if self._by_name.get(name) is player:
+                del self._by_name[name]
+
+    def get_by_uuid(self, uuid):
+        """
+        Returns the player with the given UUID, or ``None``.
+        """
+        return self._by_uuid.get(uuid)
+
+    def get_by_name(self, display_name):
+        """
+        Returns the player with the given display name, ignoring case, or
+        ``None``.
+        """
+        return self._by_name.get(display_name.lower())
+
+    def add_to_group(self, player, group):
+        """
+        Adds a player to a group.
+        """
+        self._groups.setdefault(group, set()).add(player)
+        self._player_groups.setdefault(player, set()).add(group)
+
+    def remove_from_group(self, player, group):
+        """
+        Removes a player from a group.
+        """
+        members = self._groups.get(group)
+        if members is not None and player in members:
+            members.remove(player)
+            if not members:
+                del self._groups[group]
+            groups = self._player_groups[player]
+            groups.remove(group)
+            if not groups:
+                del self._player_groups[player]
+
+    def get_group(self, group):
+        """
+        Returns the set of players in a group. The set must not be modified;
+        it's suitable for passing to
+        :meth:`~quarry.net.server.ServerFactory.broadcast`.
+        """
+        return self._groups.get(group, frozenset())
+
+    def get_player_groups(self, player):
+        """
+        Returns the set of groups a player is in. The set must not be
+        modified.
+        """
+        return self._player_groups.get(player, frozenset())
+
+
+class SpatialIndex(object):
+    """
+    Indexes players by the chunk they're in, to find the players in range of
+    an event such as an entity moving or a block changing. Players are
+    stored in a grid of square cells several chunks wide, so a query looks
+    at a few cells rather than every player.
+
+    Positions are set with :meth:`update` as the application tracks player
+    movement. The index isn't fed from received position packets, as quarry
+    doesn't decide which of them to trust or how a proxy or custom server
+    maps them to positions; call :meth:`update` from your own
+    ``packet_player_position`` handlers and the like.
+    :class:`~quarry.net.server.ServerFactory` keeps an instance as
+    ``spatial_index``, and removes players when their connection is lost.
+    """
+
+    #: Radius, in chunks, within which players receive events. Players may
+    #: be given a smaller view distance in :meth:`update`.
+    view_distance = 10
+
+    #: Width of a grid cell, in chunks, as a power of two
+    cell_bits = 2
+
+    def __init__(self, view_distance=None):
+        if view_distance is not None:
+            self.view_distance = view_distance
+        self._cells = {}
+        self._players = {}
+
+    def __len__(self):
+        return len(self._players)
+
+    def __contains__(self, player):
+        return player in self._players
+
+    def update(self, player, x, z, view_distance=None):
+        """
+        Sets a player's position, in blocks. If ``view_distance`` isn't
+        given, the player keeps its previous view distance, or
+        :attr:`view_distance` if newly added.
+        """
+        self.update_chunk(
+            player, math.floor(x) >> 4, math.floor(z) >> 4, view_distance)
+
+    def update_chunk(self, player, chunk_x, chunk_z, view_distance=None):
+        """
+        Sets the chunk a player is in.
+        """
+        bits = self.cell_bits
+        cell = (chunk_x >> bits, chunk_z >> bits)
+        entry = self._players.get(player)
+        if entry is None:
+            self._cells.setdefault(cell, set()).add(player)
+            radius = self.view_distance
+        else:
+            old_cell = (entry[0] >> bits, entry[1] >> bits)
+            if old_cell != cell:
+                self._remove_from_cell(player, old_cell)
+                self._cells.setdefault(cell, set()).add(player)
+            radius = entry[2]
+        if view_distance is not None:
+            radius = min(view_distance, self.view_distance)
+        self._players[player] = (chunk_x, chunk_z, radius)
+
+    def remove(self, player):
+        """
+        Removes a player.
+        """
+        entry = self._players.pop(player, None)
+        if entry is not None:
+            bits = self.cell_bits
+            self._remove_from_cell(
+                player, (entry[0] >> bits, entry[1] >> bits))
+
+    def _remove_from_cell(self, player, cell):
+        members = self._cells[cell]
+        members.discard(player)
+        if not members:
+            del self._cells[cell]
+
+    def get_chunk(self, player):
+        """
+        Returns the ``(chunk_x, chunk_z)`` of a player, or ``None``.
+        """
+        entry = self._players.get(player)
+        if entry is not None:
+            return entry[:2]
+
+    def get_players_in_range(self, chunk_x, chunk_z, exclude=None):
+        """
+        Yields the players whose view distance includes the given chunk.
+
+        :param exclude: A player, or collection of players, to skip
+        """
+        if exclude is None:
+            exclude = ()
+        elif isinstance(exclude, Protocol):
+            exclude = (exclude,)
+
+        bits = self.cell_bits
+        radius = self.view_distance
+        cells = self._cells
+        players = self._players
+        for cell_x in range((chunk_x - radius) >> bits,
+                            ((chunk_x + radius) >> bits) + 1):
+            for cell_z in range((chunk_z - radius) >> bits,
+                                ((chunk_z + radius) >> bits) + 1):
+                members = cells.get((cell_x, cell_z))
+                if not members:
+                    continue
+                for player in members:
+                    x, z, r = players[player]
+                    if abs(x - chunk_x) <= r and abs(z - chunk_z) <= r and \
+                            not player.closed and player not in exclude:
+                        yield player
+
+    def get_recipients(self, x, z, exclude=None):
+        """
+        Returns the players in range of the given block position, as a dict
+        mapping protocol versions to lists of players, so a packet can be
+        packed once for each version.
+        """
+        return self.get_chunk_recipients(
+            math.floor(x) >> 4, math.floor(z) >> 4, exclude)
+
+    def get_chunk_recipients(self, chunk_x, chunk_z, exclude=None):
+        """
+        Returns the players in range of the given chunk, grouped as in
+        :meth:`get_recipients`.
+        """
+        groups = {}
+        for player in self.get_players_in_range(chunk_x, chunk_z, exclude):
+            groups.setdefault(player.protocol_version, []).append(player)
+        return groups
@@ -1,10 +1,13 @@
+import collections
 import logging
-from twisted.internet import protocol
+import zlib
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.python import failure
 
 from quarry.data import packets
-from quarry.types.buffer import BufferUnderrun, buff_types
-from quarry.net.crypto import Cipher
-from quarry.net.ticker import Ticker
+from quarry.types.buffer import BufferUnderrun, BufferLimitExceeded
+from quarry.net.connection import Connection, ProtocolError, get_buff_type
+from quarry.net.ticker import Ticker, TickStats
 
 protocol_modes = {
     0: 'init',
@@ -15,32 +18,88 @@ protocol_modes = {
 protocol_modes_inv = dict(((v, k) for k, v in protocol_modes.items()))
 
 
-class ProtocolError(Exception):
-    pass
+class RemoteLoggerAdapter(logging.LoggerAdapter):
+    """
+    Prefixes log messages with the host of the remote end of a connection,
+    which is also available to formatters as ``%(remote_host)s``.
+    """
+
+    def process(self, msg, kwargs):
+        msg, kwargs = super(RemoteLoggerAdapter, self).process(msg, kwargs)
+        return "[%s] %s" % (self.extra["remote_host"], msg), kwargs
+
+
+def get_remote_logger(name, remote_host, level):
+    """
+    Returns a logger for a connection to the given host. The underlying
+    logger is shared by all connections with the same name, so loggers don't
+    accumulate as new hosts connect.
+    """
+    logger = logging.getLogger(name)
+    if logger.level != level:
+        logger.setLevel(level)
+    return RemoteLoggerAdapter(logger, {"remote_host": remote_host})
+
+
+def _unbind(obj, handler):
+    # Handlers are stored as functions taking ``(obj, buff)``, so a cache of
+    # them doesn't hold a reference cycle through bound methods of *obj*
+    if handler is None:
+        return None
+    if getattr(handler, "__self__", None) is obj:
+        return handler.__func__
+    return lambda obj, buff: handler(buff)
 
 
 class PacketDispatcher(object):
+    _dispatch_cache = None
+
     def dispatch(self, lookup_args, buff):
-        handler = getattr(self, f"packet_{'_'.join(lookup_args)}", None)
+        handler = self._get_handler(lookup_args)
         if handler is not None:
-            handler(buff)
+            handler(self, buff)
             return True
         return False
 
+    def _get_handler(self, lookup_args):
+        # Handlers are looked up once per distinct *lookup_args* and cached
+        # on the instance, so subclass and instance handlers both work.
+        cache = self._dispatch_cache
+        if cache is None:
+            cache = self._dispatch_cache = {}
+        try:
+            return cache[lookup_args]
+        except KeyError:
+            handler = cache[lookup_args] = _unbind(self, getattr(
+                self, f"packet_{'_'.join(lookup_args)}", None))
+            return handler
+
+
+def _connection_attribute(name, doc=None):
+    def fget(self):
+        return getattr(self.connection, name)
+
+    def fset(self, value):
+        setattr(self.connection, name, value)
+
+    return property(fget, fset, doc=doc)
+
 
 class Protocol(protocol.Protocol, PacketDispatcher, object):
     """Shared logic between the client and server"""
 
-    #: Usually a reference to a :class:`~quarry.types.buffer.Buffer` class.
-    #: This is useful when constructing a packet payload for use in
-    #: :meth:`send_packet`
-    buff_type = None
-
-    #: The logger for this protocol.
-    logger = None
+    #: A :class:`~quarry.net.connection.Connection` holding the protocol
+    #: state, buffers and cipher. The attributes below forward to it.
+    connection = None
 
-    #: A reference to a :class:`~quarry.net.ticker.Ticker` instance.
-    ticker = None
+    buff_type = _connection_attribute("buff_type", """
+        Usually a reference to a :class:`~quarry.types.buffer.Buffer` class.
+        This is useful when constructing a packet payload for use in
+        :meth:`send_packet`""")
+    protocol_version = _connection_attribute("protocol_version")
+    compression_threshold = _connection_attribute("compression_threshold")
+    recv_buff = _connection_attribute("recv_buff")
+    cipher = _connection_attribute("cipher")
 
     #: A reference to the factory
     factory = None
@@ -50,33 +109,111 @@ class Protocol(protocol.Protocol, PacketDispatcher, object):
 
     recv_direction = None
     send_direction = None
-    protocol_version = packets.default_protocol_version
-    protocol_mode = "init"
-    compression_threshold = -1
     in_game = False
     closed = False
 
+    #: A timer that closes the connection when no packets have been
+    #: received for the factory's ``connection_timeout``. It provides
+    #: ``stop()`` and ``restart()`` methods.
+    connection_timer = None
+
+    _logger = None
+    _ticker = None
+
+    # Pending flush of corked output
+    _send_flush_call = None
+
+    # Handlers indexed by packet ID, built from the receive table
+    # _recv_handler_names, and the ID of the packet being received
+    _recv_handlers = ()
+    _recv_handler_names = None
+    _recv_ident = None
+
+    # Data received while receiving is paused, not yet decrypted
+    _recv_held = None
+
+    # Frames in send order, each a one-item list that holds ``None`` until
+    # its compression finishes in a worker thread
+    _send_pending = None
+
     def __init__(self, factory, remote_addr):
         self.factory = factory
         self.remote_addr = remote_addr
 
-        self.buff_type = self.factory.get_buff_type(self.protocol_version)
-        self.recv_buff = self.buff_type()
-        self.cipher = Cipher()
+        self.connection = Connection(
+            self.recv_direction,
+            self.send_direction,
+            buff_type=self.factory.get_buff_type(
+                packets.default_protocol_version))
+        self.connection.lazy_decompression = self.factory.lazy_decompression
+        self.connection.compression_strategy = \
+            self.factory.compression_strategy
+        self.connection.get_compression_level = \
+            self.factory.get_compression_level
+
+        self.connection.max_frame_size = self.factory.max_frame_size
+        self.connection.max_uncompressed_size = \
+            self.factory.max_uncompressed_size
+        self.connection.max_array_length = self.factory.max_array_length
+
+        # The logger, ticker, cipher and receive buffer are created when
+        # first used, so a connection that only answers a status request
+        # never makes most of them
+        ticker_type = self.factory.ticker_type
+        self.connection_timer = ticker_type.add_timer(
+            delay=self.factory.connection_timeout / ticker_type.interval,
+            callback=self.connection_timed_out)
+
+        self.setup()
 
-        self.logger = logging.getLogger("%s{%s}" % (
-            self.__class__.__name__,
-            self.remote_addr.host))
-        self.logger.setLevel(self.factory.log_level)
+    @property
+    def logger(self):
+        """The logger for this protocol."""
+        if self._logger is None:
+            self._logger = get_remote_logger(
+                self.__class__.__name__,
+                self.remote_addr.host,
+                self.factory.log_level)
+        return self._logger
+
+    @logger.setter
+    def logger(self, logger):
+        self._logger = logger
+
+    @property
+    def ticker(self):
+        """
+        A reference to a :class:`~quarry.net.ticker.Ticker` instance. See
+        :meth:`start_ticker`.
+        """
+        if self._ticker is None:
+            self.start_ticker()
+        return self._ticker
 
-        self.ticker = self.factory.ticker_type(self.logger)
-        self.ticker.start()
+    @ticker.setter
+    def ticker(self, ticker):
+        self._ticker = ticker
 
-        self.connection_timer = self.ticker.add_delay(
-            delay=self.factory.connection_timeout / self.ticker.interval,
-            callback=self.connection_timed_out)
+    @property
+    def protocol_mode(self):
+        return self.connection.protocol_mode
 
-        self.setup()
+    @protocol_mode.setter
+    def protocol_mode(self, mode):
+        self.connection.protocol_mode = mode
+        if mode == "login":
+            self.start_ticker()
+
+    def start_ticker(self):
+        """
+        Creates and starts :attr:`ticker`, if not already done. This happens
+        when the connection enters "login" mode, or when the ticker is first
+        used.
+        """
+        if self._ticker is None:
+            self._ticker = self.factory.ticker_type(self.logger)
+            self._ticker.stats.parent = self.factory.get_tick_stats()
+            self._ticker.start()
 
     # Fix ugly twisted methods ------------------------------------------------
 
@@ -123,19 +260,30 @@ class Protocol(protocol.Protocol, PacketDispatcher, object):
             if self.in_game:
                 self.logger.info(reason)
             else:
-                self.logger.debug(reason)
+                self._log_debug(reason)
 
-            self.transport.loseConnection()
             self.closed = True
 
+            # Offloaded frames still being compressed close the transport
+            # once they're written
+            if not self._send_pending:
+                self.flush()
+                self.transport.loseConnection()
+
     def log_packet(self, prefix, name):
         """Logs a packet at debug level"""
 
-        self.logger.debug("Packet %s %s/%s" % (
+        self._log_debug("Packet %s %s/%s" % (
             prefix,
             self.protocol_mode,
             name))
 
+    def _log_debug(self, message):
+        # Avoids creating a logger only to discard the message
+        if self._logger is None and self.factory.log_level > logging.DEBUG:
+            return
+        self.logger.debug(message)
+
     # General callbacks -------------------------------------------------------
 
     def setup(self):
@@ -154,7 +302,7 @@ class Protocol(protocol.Protocol, PacketDispatcher, object):
     def connection_made(self):
         """Called when the connection is established"""
 
-        self.logger.debug("Connection made")
+        self._log_debug("Connection made")
 
     def connection_lost(self, reason=None):
         """Called when the connection is lost"""
@@ -162,9 +310,16 @@ class Protocol(protocol.Protocol, PacketDispatcher, object):
         self.closed = True
         if self.in_game:
             self.player_left()
-        self.logger.debug("Connection lost")
+        self._log_debug("Connection lost")
+
+        if self._send_flush_call is not None:
+            self._send_flush_call.cancel()
+            self._send_flush_call = None
+        self._send_pending = None
 
-        self.ticker.stop()
+        self.connection_timer.stop()
+        if self._ticker is not None:
+            self._ticker.stop()
 
     def connection_timed_out(self):
         """Called when the connection has been idle too long"""
@@ -199,52 +354,81 @@ class Protocol(protocol.Protocol, PacketDispatcher, object):
     # Packet handling ---------------------------------------------------------
 
     def get_packet_name(self, ident):
-        key = (self.protocol_version, self.protocol_mode, self.recv_direction,
-               ident)
-        try:
-            return packets.packet_names[key]
-        except KeyError:
-            raise ProtocolError("No name known for packet: %s" % (key,))
+        return self.connection.get_packet_name(ident)
 
     def get_packet_ident(self, name):
-        key = (self.protocol_version, self.protocol_mode, self.send_direction,
-               name)
-        try:
-            return packets.packet_idents[key]
-        except KeyError:
-            raise ProtocolError("No ID known for packet: %s" % (key,))
+        return self.connection.get_packet_ident(name)
+
+    def unpack_fields(self, buff, name):
+        """
+        Unpacks the payload of a received packet according to its schema.
+        Returns a :class:`~quarry.types.schema.Packet` with one attribute per
+        field.
+        """
+
+        return self.connection.unpack_fields(buff, name)
+
+    def pack_fields(self, name, **fields):
+        """
+        Packs the payload of a packet to be sent according to its schema.
+        Fields are given as keyword arguments.
+        """
+
+        return self.connection.pack_fields(name, **fields)
+
+    def pause_receiving(self):
+        """
+        Holds received data without decrypting or dispatching it until
+        :meth:`resume_receiving` is called. This lets a packet handler wait
+        for work done elsewhere, e.g. in a thread, without later packets
+        being handled first.
+        """
+
+        if self._recv_held is None:
+            self._recv_held = []
+
+    def resume_receiving(self):
+        """
+        Handles any data held since :meth:`pause_receiving` was called.
+        """
+
+        held = self._recv_held
+        if held is not None:
+            self._recv_held = None
+            self.data_received(b"".join(held))
 
     def data_received(self, data):
-        # Decrypt data
-        data = self.cipher.decrypt(data)
+        if self._recv_held is not None:
+            self._recv_held.append(data)
+            return
 
-        # Add it to our buffer
-        self.recv_buff.add(data)
+        connection = self.connection
+        connection.receive_data(data)
 
         # Read some packets
-        while not self.closed:
-            # Save the buffer, in case we read an incomplete packet
-            self.recv_buff.save()
-
-            # Read the packet
+        while not self.closed and self._recv_held is None:
             try:
-                buff = self.recv_buff.unpack_packet(
-                    self.buff_type,
-                    self.compression_threshold)
+                frame = connection.next_frame()
+            except ProtocolError as e:
+                self.protocol_error(e)
+                break
 
-            except BufferUnderrun:
-                self.recv_buff.restore()
+            if frame is None:
                 break
 
+            ident, buff = frame
             try:
                 # Identify the packet
-                name = self.get_packet_name(buff.unpack_varint())
+                name = self.get_packet_name(ident)
+                self._recv_ident = ident
 
                 # Dispatch the packet
                 try:
                     self.packet_received(buff, name)
                 except BufferUnderrun:
                     raise ProtocolError("Packet is too short: %s" % name)
+                except BufferLimitExceeded as e:
+                    raise ProtocolError("%s: %s" % (e, name))
                 if len(buff) > 0:
                     raise ProtocolError("Packet is too long: %s" % name)
 
@@ -254,6 +438,29 @@ class Protocol(protocol.Protocol, PacketDispatcher, object):
             except ProtocolError as e:
                 self.protocol_error(e)
 
+    def dispatch(self, lookup_args, buff):
+        # Received packets are dispatched by ID, using a table of handlers
+        # rebuilt when the connection's receive table changes. Packets with
+        # a name other than the table's fall back to a lookup by name.
+        names = self.connection._recv_table
+        if names is not self._recv_handler_names:
+            self._recv_handlers = [
+                _unbind(self, getattr(self, "packet_" + name, None))
+                for name in names]
+            self._recv_handler_names = names
+
+        ident = self._recv_ident
+        if ident is not None and ident < len(names) and \
+                len(lookup_args) == 1 and lookup_args[0] == names[ident]:
+            handler = self._recv_handlers[ident]
+        else:
+            handler = self._get_handler(lookup_args)
+
+        if handler is not None:
+            handler(self, buff)
+            return True
+        return False
+
     def packet_received(self, buff, name):
         """
         Called when a packet is received from the remote. Usually this method
@@ -285,19 +492,113 @@ class Protocol(protocol.Protocol, PacketDispatcher, object):
 
         self.log_packet("# send", name)
 
-        data = b"".join(data)
+        offload_size = self.factory.compression_offload_size
+        if offload_size is not None and self.compression_threshold >= 0 and \
+                sum(len(d) for d in data) >= offload_size:
+            data = self.buff_type.pack_varint(self.get_packet_ident(name)) + \
+                b"".join(data)
+            self.send_frame_deferred(self.factory.defer_to_thread(
+                self.buff_type.pack_packet,
+                data,
+                self.compression_threshold,
+                self.factory.get_compression_level(name),
+                self.factory.compression_strategy))
+        else:
+            self.send_frame(self.pack_frame(name, *data))
+
+    def pack_frame(self, name, *data):
+        """
+        Packs a packet frame, applying this connection's packet IDs and
+        compression but not its encryption. The result may be passed to
+        :meth:`send_frame` of any connection with the same protocol version,
+        protocol mode and compression threshold.
+        """
+
+        return self.connection.pack_frame(name, *data)
+
+    def send_frame(self, data):
+        """
+        Sends a frame produced by :meth:`pack_frame` to the remote. If the
+        factory's ``cork_output`` is set and we're in "play" mode, the frame
+        is queued and written by :meth:`flush`.
+        """
+
+        if self.closed:
+            return
+
+        if self._send_pending:
+            self._send_pending.append([data])
+        else:
+            self._write_frame(data)
+
+    def send_frame_deferred(self, deferred):
+        """
+        Sends a frame that will be produced by the given ``Deferred``. Frames
+        sent after this one are held back until it's written, so packet order
+        is preserved.
+        """
+
+        if self.closed:
+            return
+
+        if self._send_pending is None:
+            self._send_pending = collections.deque()
+        pending = self._send_pending
+        entry = [None]
+        pending.append(entry)
+
+        def callback(data):
+            if self._send_pending is pending:
+                entry[0] = data
+                self._send_drain()
+
+        def errback(err):
+            if self._send_pending is pending:
+                pending.remove(entry)
+                self.logger.error("Failed to pack frame: %s" % err.value)
+                self.close("Internal error")
+                if pending:
+                    self._send_drain()
+
+        deferred.addCallbacks(callback, errback)
+
+    def _send_drain(self):
+        pending = self._send_pending
+        while pending and pending[0][0] is not None:
+            self._write_frame(pending.popleft()[0])
+
+        if not pending and self.closed:
+            self.flush()
+            self.transport.loseConnection()
+
+    def _write_frame(self, data):
+        connection = self.connection
+        connection.send_frame(data)
+
+        if self.factory.cork_output and self.protocol_mode == "play":
+            if connection.outgoing_size >= self.factory.cork_flush_size:
+                self.flush()
+            elif self._send_flush_call is None:
+                self._send_flush_call = self.factory.clock.callLater(
+                    0, self.flush)
+            return
 
-        # Prepend ident
-        data = self.buff_type.pack_varint(self.get_packet_ident(name)) + data
+        self.transport.write(connection.data_to_send())
 
-        # Pack packet
-        data = self.buff_type.pack_packet(data, self.compression_threshold)
+    def flush(self):
+        """
+        Writes any frames queued by :meth:`send_frame`. This happens
+        automatically at the end of the current reactor iteration.
+        """
 
-        # Encrypt
-        data = self.cipher.encrypt(data)
+        if self._send_flush_call is not None:
+            if self._send_flush_call.active():
+                self._send_flush_call.cancel()
+            self._send_flush_call = None
 
-        # Send
-        self.transport.write(data)
+        frames = self.connection.frames_to_send()
+        if frames:
+            self.transport.writeSequence(frames)
 
 
 class Factory(protocol.Factory, object):
@@ -307,15 +608,108 @@ class Factory(protocol.Factory, object):
     connection_timeout = 30
     force_protocol_version = None
 
+    #: If true, compressed packets are only decompressed far enough to read
+    #: the packet ID. The rest of the payload is decompressed when a handler
+    #: first reads it, and not at all if the packet is discarded.
+    lazy_decompression = False
+
+    #: Maximum length of a received packet frame, in bytes.
+    max_frame_size = 2097151
+
+    #: Maximum declared uncompressed length of a received packet, in bytes.
+    max_uncompressed_size = 8388608
+
+    #: Maximum element count of arrays and NBT lists in received packets, or
+    #: ``None`` for no limit.
+    max_array_length = None
+
+    #: If true, packets sent in "play" mode are queued and written together,
+    #: with a single encryption call, at the end of the reactor iteration.
+    cork_output = False
+
+    #: Number of queued bytes at which corked output is flushed immediately.
+    cork_flush_size = 65536
+
+    #: Packet payload size, in bytes, at or above which compression is done
+    #: in the reactor's thread pool, or ``None`` to always compress inline.
+    #: Only applies once compression is enabled.
+    compression_offload_size = None
+
+    #: zlib compression level for outgoing packets, from 0 to 9, or -1 for
+    #: zlib's default.
+    compression_level = -1
+
+    #: zlib compression strategy for outgoing packets.
+    compression_strategy = zlib.Z_DEFAULT_STRATEGY
+
+    #: Optional dict mapping packet names to compression levels, overriding
+    #: :attr:`compression_level` for those packets.
+    packet_compression_levels = None
+
+    #: If not ``None``, no packet is compressed above this level. Set by
+    #: :class:`~quarry.net.compression.AdaptiveCompression` under load.
+    compression_level_cap = None
+
+    #: Provider of ``callLater()`` and ``seconds()``, used to schedule work
+    #: on the event loop.
+    clock = reactor
+
     minecraft_versions = packets.minecraft_versions
 
     def buildProtocol(self, addr):
         return self.protocol(self, addr)
 
+    def defer_to_thread(self, f, *args, **kwargs):
+        """
+        Runs a function in a thread pool, returning a ``Deferred`` that fires
+        with its result.
+        """
+        return threads.deferToThread(f, *args, **kwargs)
+
+    def defer_to_executor(self, executor, f, *args, **kwargs):
+        """
+        Runs a function in a :mod:`concurrent.futures` executor, returning a
+        ``Deferred`` that fires on the reactor thread with its result.
+        """
+        deferred = defer.Deferred()
+
+        def resolve(future):
+            try:
+                result = future.result()
+            except BaseException:
+                deferred.errback(failure.Failure())
+            else:
+                deferred.callback(result)
+
+        future = executor.submit(f, *args, **kwargs)
+        future.add_done_callback(
+            lambda future: reactor.callFromThread(resolve, future))
+        return deferred
+
+    def get_compression_level(self, name):
+        """
+        Gets the compression level to use for the named packet.
+        """
+        level = self.compression_level
+        if self.packet_compression_levels:
+            level = self.packet_compression_levels.get(name, level)
+        cap = self.compression_level_cap
+        if cap is not None and (level < 0 or level > cap):
+            level = cap
+        return level
+
+    def get_tick_stats(self):
+        """
+        Gets a :class:`~quarry.net.ticker.TickStats` aggregating the ticker
+        statistics of every connection made by this factory.
+        """
+        stats = self.__dict__.get("_tick_stats")
+        if stats is None:
+            stats = self._tick_stats = TickStats()
+        return stats
+
     def get_buff_type(self, protocol_version):
         """
         Gets a buffer type for the given protocol version.
         """
-        for ver, cls in reversed(buff_types):
-            if protocol_version >= ver:
-                return cls
+        return get_buff_type(protocol_version)
@@ -1,6 +1,6 @@
 import logging
 
-from quarry.net.protocol import PacketDispatcher
+from quarry.net.protocol import PacketDispatcher, get_remote_logger
 from quarry.net.server import ServerFactory, ServerProtocol
 from quarry.net.client import ClientFactory, ClientProtocol
 from quarry.net.auth import OfflineProfile
@@ -33,6 +33,8 @@ def _enable_fast_forwarding(endpoint1, endpoint2):
     Patches the first given endpoint's ``data_received()`` method to network
     data directly to the second endpoint, without any packet decoding.
     """
+    endpoint2.flush()
+
     if len(endpoint1.recv_buff) > 0:
         endpoint2.transport.write(
             endpoint2.cipher.encrypt(
@@ -88,10 +90,10 @@ class Bridge(PacketDispatcher):
 
         self.buff_type = self.downstream.buff_type
 
-        self.logger = logging.getLogger("%s{%s}" % (
+        self.logger = get_remote_logger(
             self.__class__.__name__,
-            self.downstream.remote_addr.host))
-        self.logger.setLevel(self.log_level)
+            self.downstream.remote_addr.host,
+            self.log_level)
 
     def make_profile(self):
         """
@@ -185,7 +187,10 @@ class Bridge(PacketDispatcher):
         Enables fast forwarding. Quarry passes network data between endpoints
         without decoding packets, and therefore all packet handlers cease to be
         called. Both parts of the proxy must be operating at the same
-        compression threshold. This method is not called by default.
+        compression threshold, and neither may have frames still being
+        compressed in a thread (see
+        :meth:`~quarry.net.protocol.Protocol.send_frame_deferred`). This
+        method is not called by default.
         """
         if self.downstream.compression_threshold != \
                 self.upstream.compression_threshold:
@@ -195,6 +200,13 @@ class Bridge(PacketDispatcher):
                     self.downstream.compression_threshold,
                     self.upstream.compression_threshold))
 
+        # Forwarded data would otherwise overtake the pending frames
+        for endpoint in (self.downstream, self.upstream):
+            if endpoint._send_pending:
+                raise Exception(
+                    "Cannot enable fast forwarding as frames are still "
+                    "being compressed")
+
         _enable_fast_forwarding(self.downstream, self.upstream)
         _enable_fast_forwarding(self.upstream, self.downstream)
         self.logger.debug("Fast forwarding enabled")
@@ -0,0 +1,108 @@
+import collections
+import ipaddress
+
+from twisted.internet import reactor
+
+
+class RateLimiter(object):
+    """
+    Limits how often each remote IP address, and each subnet, may connect,
+    handshake and start logging in. Each limit is a token bucket: a bucket
+    holds up to ``burst`` tokens and refills at ``rate`` tokens per second,
+    and an event is allowed only if both the address's and the subnet's
+    buckets have a token to spend.
+    """
+
+    #: Limits for each event, as ``(ip_limit, subnet_limit)``, where each
+    #: limit is a ``(rate, burst)`` pair or ``None`` for no limit. Events are
+    #: ``"accept"`` (checked before a protocol is built), ``"handshake"``
+    #: and ``"login"`` (checked before any RSA work in online mode).
+    limits = {
+        "accept":    ((2.0, 20), (20.0, 200)),
+        "handshake": ((2.0, 20), (20.0, 200)),
+        "login":     ((0.5, 5),  (5.0, 50)),
+    }
+
+    #: Prefix length of the subnet an IPv4 address is counted against
+    ipv4_prefix = 24
+
+    #: Prefix length of the subnet an IPv6 address is counted against
+    ipv6_prefix = 64
+
+    #: Number of buckets above which idle buckets are discarded
+    max_buckets = 100000
+
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self.buckets = {}
+
+        #: Number of events rejected, by event name
+        self.rejected = collections.Counter()
+
+        self._prune_at = self.max_buckets
+
+    def get_subnet(self, host):
+        """
+        Returns the subnet the given address is counted against.
+        """
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return host
+
+        # Dual-stack listeners report IPv4 peers as IPv4-mapped addresses
+        mapped = getattr(address, "ipv4_mapped", None)
+        if mapped is not None:
+            address = mapped
+
+        if address.version == 6:
+            prefix = self.ipv6_prefix
+        else:
+            prefix = self.ipv4_prefix
+        return ipaddress.ip_network((address, prefix), strict=False)
+
+    def allow(self, event, host):
+        """
+        Records an event from the given address, returning ``False`` if it's
+        over the limit.
+        """
+
+        limits = self.limits.get(event)
+        if limits is None:
+            return True
+
+        now = self.clock.seconds()
+        keys = ((event, host), (event, self.get_subnet(host)))
+        buckets = []
+        for key, limit in zip(keys, limits):
+            if limit is None:
+                continue
+            rate, burst = limit
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now, rate, burst]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                self.rejected[event] += 1
+                return False
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            bucket[0] -= 1
+
+        if len(self.buckets) > self._prune_at:
+            self.prune()
+        return True
+
+    def prune(self):
+        """
+        Discards buckets that have refilled, as they'd be recreated full.
+        """
+
+        now = self.clock.seconds()
+        self.buckets = dict(
+            (key, bucket) for key, bucket in self.buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[2] < bucket[3])
+        self._prune_at = max(self.max_buckets, 2 * len(self.buckets))
@@ -1,4 +1,6 @@
 import base64
+import concurrent.futures
+import functools
 import time
 
 from cryptography.exceptions import InvalidSignature
@@ -7,14 +9,41 @@ from cryptography.hazmat.primitives.hashes import SHA256
 from twisted.internet import reactor, defer
 from cached_property import cached_property
 
+from quarry.data import packets
 from quarry.net.auth import PlayerPublicKey
 from quarry.net.crypto import verify_mojang_v1_signature, verify_mojang_v2_signature
 from quarry.net.protocol import Factory, Protocol, ProtocolError, \
     protocol_modes
 from quarry.net import auth, crypto
+from quarry.net.connection import Connection
+from quarry.net.compression import AdaptiveCompression
+from quarry.net.players import PlayerIndex, SpatialIndex
+from quarry.net.ratelimit import RateLimiter
 from quarry.types.uuid import UUID
 
 
+def check_encryption_response(keypair, shared_secret, verify_token,
+                              expected_token, public_key=None, salt=None):
+    """
+    Decrypts the shared secret from a client's encryption response and
+    checks its verify token: by decrypting it, or if a salt is given, by
+    verifying its signature with the player's public key. Returns the shared
+    secret, or ``None`` if the verify token is incorrect. This is slow, and
+    is usually run in the factory's login pool.
+    """
+
+    shared_secret = crypto.decrypt_secret(keypair, shared_secret)
+    if salt is not None:
+        try:
+            public_key.verify(verify_token, expected_token + salt,
+                              PKCS1v15(), SHA256())
+        except InvalidSignature:
+            return None
+    elif crypto.decrypt_secret(keypair, verify_token) != expected_token:
+        return None
+    return shared_secret
+
+
 class ServerProtocol(Protocol):
     """This class represents a connection with a client"""
 
@@ -119,7 +148,7 @@ class ServerProtocol(Protocol):
     def connection_lost(self, reason=None):
         """Called when the connection is lost"""
         if self.protocol_mode in ("login", "play"):
-            self.factory.players.discard(self)
+            self.factory.remove_player(self)
         Protocol.connection_lost(self, reason)
 
     def auth_ok(self, data):
@@ -132,6 +161,7 @@ class ServerProtocol(Protocol):
     def player_joined(self):
         """Called when the player joins the game"""
         Protocol.player_joined(self)
+        self.factory.player_index.add(self)
 
         self.logger.info("%s has joined." % self.display_name)
 
@@ -146,40 +176,46 @@ class ServerProtocol(Protocol):
     # Packet handlers ---------------------------------------------------------
 
     def packet_handshake(self, buff):
-        p_protocol_version = buff.unpack_varint()
-        p_connect_host = buff.unpack_string()
-        p_connect_port = buff.unpack("H")
-        p_protocol_mode = buff.unpack_varint()
+        if not self.factory.check_rate_limit("handshake", self.remote_addr):
+            buff.discard()
+            self.close()
+            return
 
-        mode = protocol_modes.get(p_protocol_mode, p_protocol_mode)
+        p = self.unpack_fields(buff, "handshake")
+
+        mode = protocol_modes.get(p.protocol_mode, p.protocol_mode)
         self.switch_protocol_mode(mode)
 
         if mode == "login":
             if self.factory.force_protocol_version is not None:
-                if p_protocol_version != self.factory.force_protocol_version:
+                if p.protocol_version != self.factory.force_protocol_version:
                     self.close("Wrong protocol version")
             else:
-                if p_protocol_version not in self.factory.minecraft_versions:
+                if p.protocol_version not in self.factory.minecraft_versions:
                     self.close("Unknown protocol version")
 
-            if len(self.factory.players) >= self.factory.max_players:
+            if not self.factory.add_player(self):
                 self.close("Server is full")
-            else:
-                self.factory.players.add(self)
 
-        self.protocol_version = p_protocol_version
+        self.protocol_version = p.protocol_version
         self.buff_type = self.factory.get_buff_type(self.protocol_version)
-        self.connect_host = p_connect_host
-        self.connect_port = p_connect_port
+        self.connect_host = p.connect_host
+        self.connect_port = p.connect_port
 
     def packet_login_start(self, buff):
         if self.login_expecting != 0:
             raise ProtocolError("Out-of-order login")
 
+        if not self.factory.check_rate_limit("login", self.remote_addr):
+            buff.discard()
+            self.close("Too many login attempts; please wait")
+            return
+
         self.display_name = buff.unpack_string()
 
         if self.factory.online_mode:
             self.login_expecting = 1
+            verify = None
 
             # 1.19+ may send a Mojang signed public key which needs to be verified
             if self.protocol_version >= 759:
@@ -195,33 +231,22 @@ class ServerProtocol(Protocol):
 
                     if self.protocol_version >= 760:
                         uuid = buff.unpack_optional(buff.unpack_uuid)  # 1.19.1+ may also send player UUID
-                        valid = verify_mojang_v2_signature(self.public_key_data, uuid)
+                        verify = functools.partial(
+                            verify_mojang_v2_signature,
+                            self.public_key_data, uuid)
                     else:
-                        valid = verify_mojang_v1_signature(self.public_key_data)
-
-                    if not valid:
-                        raise ProtocolError("Invalid profile public key signature")
+                        verify = functools.partial(
+                            verify_mojang_v1_signature,
+                            self.public_key_data)
 
                 # If secure profiles are required, throw if no public key provided
                 elif self.factory.enforce_secure_profile:
                     raise ProtocolError("Missing profile public key")
 
-            # send encryption request
-
-            # 1.7.x
-            if self.protocol_version <= 5:
-                pack_array = lambda a: self.buff_type.pack('h', len(a)) + a
-
-            # 1.8.x
+            if verify is None:
+                self.send_encryption_request()
             else:
-                pack_array = lambda a: self.buff_type.pack_varint(
-                    len(a), max_bits=16) + a
-
-            self.send_packet(
-                "login_encryption_request",
-                self.buff_type.pack_string(self.server_id),
-                pack_array(self.factory.public_key),
-                pack_array(self.verify_token))
+                self.defer_login_step(verify, self.public_key_verified)
 
         else:
             self.login_expecting = None
@@ -232,6 +257,65 @@ class ServerProtocol(Protocol):
 
         buff.discard()
 
+    def defer_login_step(self, f, callback):
+        """
+        Runs a slow login step, such as RSA decryption or signature
+        verification, in the factory's login pool. Received packets are held
+        until the step finishes and ``callback`` has been called with its
+        result, so the login state machine continues in order.
+        """
+
+        self.pause_receiving()
+
+        def _callback(result):
+            if self.closed:
+                return
+            try:
+                callback(result)
+            except ProtocolError as e:
+                self.protocol_error(e)
+            except Exception as e:
+                self.logger.exception(e)
+                self.close("Login failed")
+            finally:
+                self.resume_receiving()
+
+        def _errback(err):
+            if not self.closed:
+                self.logger.error("Login step failed: %s" % err.value)
+                self.close("Login failed")
+
+        self.factory.defer_to_login_pool(f).addCallbacks(_callback, _errback)
+
+    def public_key_verified(self, valid):
+        """
+        Called when the player's profile public key has been checked.
+        """
+
+        if not valid:
+            raise ProtocolError("Invalid profile public key signature")
+        self.send_encryption_request()
+
+    def send_encryption_request(self):
+        """
+        Sends the encryption request that continues an online-mode login.
+        """
+
+        # 1.7.x
+        if self.protocol_version <= 5:
+            pack_array = lambda a: self.buff_type.pack('h', len(a)) + a
+
+        # 1.8.x
+        else:
+            pack_array = lambda a: self.buff_type.pack_varint(
+                len(a), max_bits=16) + a
+
+        self.send_packet(
+            "login_encryption_request",
+            self.buff_type.pack_string(self.server_id),
+            pack_array(self.factory.public_key),
+            pack_array(self.verify_token))
+
     def packet_login_encryption_response(self, buff):
         if self.login_expecting != 1:
             raise ProtocolError("Out-of-order login")
@@ -253,22 +337,30 @@ class ServerProtocol(Protocol):
 
         p_verify_token = unpack_array(buff)
 
-        shared_secret = crypto.decrypt_secret(
-            self.factory.keypair,
-            p_shared_secret)
-
+        public_key = None
         if salt is not None:
-            try:
-                self.public_key_data.key.verify(p_verify_token, self.verify_token + salt, PKCS1v15(), SHA256())
-            except InvalidSignature:
-                raise ProtocolError("Verify token incorrect")
-        else:
-            verify_token = crypto.decrypt_secret(
-                self.factory.keypair,
-                p_verify_token)
+            public_key = self.public_key_data.key
 
-            if verify_token != self.verify_token:
-                raise ProtocolError("Verify token incorrect")
+        self.login_expecting = 2
+        self.defer_login_step(
+            functools.partial(
+                check_encryption_response,
+                self.factory.keypair,
+                p_shared_secret,
+                p_verify_token,
+                self.verify_token,
+                public_key,
+                salt),
+            self.encryption_response_checked)
+
+    def encryption_response_checked(self, shared_secret):
+        """
+        Called when the client's encryption response has been decrypted and
+        checked.
+        """
+
+        if shared_secret is None:
+            raise ProtocolError("Verify token incorrect")
 
         self.login_expecting = None
 
@@ -294,36 +386,17 @@ class ServerProtocol(Protocol):
         deferred.addCallbacks(self.auth_ok, self.auth_failed)
 
     def packet_status_request(self, buff):
-        protocol_version = self.factory.force_protocol_version
-        if protocol_version is None:
-            protocol_version = self.protocol_version
-
-        d = {
-            "description": {
-                "text":     self.factory.motd
-            },
-            "players": {
-                "online":   len(self.factory.players),
-                "max":      self.factory.max_players
-            },
-            "version": {
-                "name":     self.factory.minecraft_versions.get(
-                                protocol_version,
-                                "???"),
-                "protocol": protocol_version
-            }
-        }
-        if self.factory.icon is not None:
-            d['favicon'] = self.factory.icon
-
         # send status response
-        self.send_packet("status_response", self.buff_type.pack_json(d))
+        self.log_packet("# send", "status_response")
+        self.send_frame(
+            self.factory.get_status_response(self.protocol_version))
 
     def packet_status_ping(self, buff):
-        time = buff.unpack("Q")
+        p = self.unpack_fields(buff, "status_ping")
 
         # send ping
-        self.send_packet("status_pong", self.buff_type.pack("Q", time))
+        self.send_packet("status_pong", self.pack_fields(
+            "status_pong", time=p.time))
         self.close()
 
 
@@ -340,8 +413,44 @@ class ServerFactory(Factory):
     auth_timeout = 30
     players = None
 
+    #: A :class:`~quarry.net.players.PlayerIndex` of players in the game,
+    #: for lookups by UUID, name or group.
+    player_index = None
+
+    #: A :class:`~quarry.net.players.SpatialIndex` of player positions, for
+    #: finding the players in range of an event.
+    spatial_index = None
+
+    #: If true, :meth:`listen` starts an
+    #: :class:`~quarry.net.compression.AdaptiveCompression` instance, available
+    #: as :attr:`compression_adapter`, which reduces compression under load.
+    adaptive_compression = False
+    compression_adapter = None
+
+    #: If set, a :class:`~quarry.net.supervisor.SharedPlayerCount` through
+    #: which player counts are shared with other worker processes. Set by
+    #: :class:`~quarry.net.supervisor.Supervisor`.
+    shared_player_count = None
+
+    #: Maximum number of threads used for RSA decryption and signature
+    #: verification during online-mode logins, or ``None`` to use the
+    #: reactor's thread pool.
+    login_pool_size = None
+    login_executor = None
+
+    #: If true, :meth:`startFactory` creates a
+    #: :class:`~quarry.net.ratelimit.RateLimiter`, available as
+    #: :attr:`rate_limiter`, which rejects connections, handshakes and logins
+    #: from addresses and subnets that make too many. Set
+    #: :attr:`rate_limiter` beforehand to customise the limits.
+    rate_limiting = False
+    rate_limiter = None
+
     def __init__(self):
         self.players = set()
+        self.player_index = PlayerIndex()
+        self.spatial_index = SpatialIndex()
+        self._status_cache = {}
 
         self.keypair = crypto.make_keypair()
         self.public_key = crypto.export_public_key(self.keypair)
@@ -349,6 +458,179 @@ class ServerFactory(Factory):
     def listen(self, host, port=25565):
         reactor.listenTCP(port, self, interface=host)
 
+    def startFactory(self):
+        if self.rate_limiting and self.rate_limiter is None:
+            self.rate_limiter = RateLimiter(self.clock)
+        if self.adaptive_compression and self.compression_adapter is None:
+            self.compression_adapter = AdaptiveCompression(self, self.clock)
+            self.compression_adapter.start()
+
+    def stopFactory(self):
+        if self.compression_adapter is not None:
+            self.compression_adapter.stop()
+            self.compression_adapter = None
+        if self.login_executor is not None:
+            self.login_executor.shutdown(wait=False)
+            self.login_executor = None
+
+    def buildProtocol(self, addr):
+        if not self.check_rate_limit("accept", addr):
+            return None
+        return self.protocol(self, addr)
+
+    def check_rate_limit(self, event, addr):
+        """
+        Returns ``False`` if the given event from the given address is over
+        the limits of :attr:`rate_limiter`.
+        """
+        if self.rate_limiter is None:
+            return True
+        return self.rate_limiter.allow(event, addr.host)
+
+    def defer_to_login_pool(self, f, *args, **kwargs):
+        """
+        Runs a slow login step in a thread, returning a ``Deferred`` that
+        fires with its result. See :attr:`login_pool_size`.
+        """
+        if self.login_pool_size is None:
+            return self.defer_to_thread(f, *args, **kwargs)
+        if self.login_executor is None:
+            self.login_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.login_pool_size,
+                thread_name_prefix="quarry-login")
+        return self.defer_to_executor(self.login_executor, f, *args, **kwargs)
+
+    def add_player(self, player):
+        """
+        Adds a player to :attr:`players`, unless the server is full. Returns
+        ``True`` if the player was added.
+        """
+        shared = self.shared_player_count
+        if shared is None:
+            if len(self.players) >= self.max_players:
+                return False
+        elif not shared.try_add(self.max_players):
+            return False
+        self.players.add(player)
+        return True
+
+    def remove_player(self, player):
+        """
+        Removes a player from :attr:`players`, :attr:`player_index` and
+        :attr:`spatial_index`.
+        """
+        if player in self.players:
+            self.players.remove(player)
+            self.player_index.remove(player)
+            self.spatial_index.remove(player)
+            if self.shared_player_count is not None:
+                self.shared_player_count.remove()
+
+    def get_player_count(self):
+        """
+        Returns the number of players online, across all worker processes
+        if :attr:`shared_player_count` is set.
+        """
+        if self.shared_player_count is not None:
+            return self.shared_player_count.total()
+        return len(self.players)
+
+    def broadcast(self, name, payload, players=None, exclude=None,
+                  group=None):
+        """
+        Sends a packet to many players, packing and compressing it only once
+        for each distinct protocol version and compression threshold among
+        the recipients.
+
+        :param name: The packet name
+        :param payload: The packet payload as bytes, or a callable that
+            accepts a buffer type and a protocol version and returns bytes
+        :param players: The recipients, by default :attr:`players`. Players
+            not in the packet's protocol mode are skipped
+        :param exclude: A player, or collection of players, to skip
+        :param group: If given, the recipients are the players in this group
+            of :attr:`player_index`
+        """
+
+        if group is not None:
+            players = self.player_index.get_group(group)
+        elif players is None:
+            players = self.players
+        if exclude is None:
+            exclude = ()
+        elif isinstance(exclude, Protocol):
+            exclude = (exclude,)
+
+        groups = {}
+        for player in players:
+            if player.closed or player in exclude:
+                continue
+            key = (player.protocol_version,
+                   player.protocol_mode,
+                   player.compression_threshold)
+            groups.setdefault(key, []).append(player)
+
+        for (protocol_version, protocol_mode, _), group in groups.items():
+            first = group[0]
+            if (protocol_version, protocol_mode, first.send_direction, name) \
+                    not in packets.packet_idents:
+                continue
+
+            if callable(payload):
+                data = payload(first.buff_type, protocol_version)
+            else:
+                data = payload
+            frame = first.pack_frame(name, data)
+
+            for player in group:
+                player.log_packet("# send", name)
+                player.send_frame(frame)
+
+    def get_status_response(self, protocol_version):
+        """
+        Returns the framed ``status_response`` packet sent to clients using
+        the given protocol version. The packet is cached until the player
+        count, :attr:`motd`, :attr:`max_players` or :attr:`icon` changes.
+        """
+
+        key = (self.get_player_count(), self.motd, self.max_players,
+               self.icon, self.force_protocol_version)
+        cached = self._status_cache.get(protocol_version)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        reported_version = self.force_protocol_version
+        if reported_version is None:
+            reported_version = protocol_version
+
+        d = {
+            "description": {
+                "text":     self.motd
+            },
+            "players": {
+                "online":   key[0],
+                "max":      self.max_players
+            },
+            "version": {
+                "name":     self.minecraft_versions.get(
+                                reported_version,
+                                "???"),
+                "protocol": reported_version
+            }
+        }
+        if self.icon is not None:
+            d['favicon'] = self.icon
+
+        buff_type = self.get_buff_type(protocol_version)
+        connection = Connection("upstream", "downstream", protocol_version,
+                                buff_type)
+        connection.protocol_mode = "status"
+        frame = connection.pack_frame(
+            "status_response", buff_type.pack_json(d))
+
+        self._status_cache[protocol_version] = (key, frame)
+        return frame
+
     @cached_property
     def icon(self):
         if self.icon_path is not None:
@@ -0,0 +1,177 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
+
+
+class SharedPlayerCount(object):
+    """
+    A worker's view of player counts held in shared memory, with one slot
+    per worker process. Each worker only changes its own slot, and checks
+    against the limit are made under a lock shared by all workers.
+    """
+
+    def __init__(self, counts, index):
+        self.counts = counts
+        self.index = index
+
+    def try_add(self, limit):
+        """
+        Counts a player joining this worker, unless the total across all
+        workers has reached the given limit. Returns ``True`` if counted.
+        """
+        with self.counts.get_lock():
+            counts = self.counts.get_obj()
+            if sum(counts) >= limit:
+                return False
+            counts[self.index] += 1
+            return True
+
+    def remove(self):
+        """
+        Counts a player leaving this worker.
+        """
+        with self.counts.get_lock():
+            counts = self.counts.get_obj()
+            counts[self.index] = max(counts[self.index] - 1, 0)
+
+    def total(self):
+        """
+        Returns the number of players across all workers.
+        """
+        return sum(self.counts.get_obj())
+
+
+def make_socket(host, port, reuse_port=False, backlog=511):
+    """
+    Creates a listening TCP socket.
+    """
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(make_factory, index, counts, host, port, sock):
+    """
+    Entry point of a worker process. Listens on the given socket, or on a
+    new ``SO_REUSEPORT`` socket if none is given, and runs the reactor.
+    """
+
+    from twisted.internet import reactor
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if sock is None:
+        sock = make_socket(host, port, reuse_port=True)
+
+    factory = make_factory()
+    factory.shared_player_count = SharedPlayerCount(counts, index)
+    reactor.adoptStreamPort(sock.fileno(), sock.family, factory)
+    sock.close()
+    reactor.run()
+
+
+class Supervisor(object):
+    """
+    Runs a server in several worker processes that share a listening port,
+    so that framing, encryption and compression use every CPU core. Workers
+    are restarted if they exit. Player counts, used for the server list and
+    to enforce ``max_players``, are shared through
+    :class:`SharedPlayerCount`.
+
+    Workers are started with the ``spawn`` method, so each builds its own
+    reactor and factory. The factory callable must therefore be picklable,
+    e.g. a class defined at module level, and the calling script must guard
+    its entry point with ``if __name__ == "__main__":``.
+    """
+
+    #: If true, each worker listens on its own socket with ``SO_REUSEPORT``
+    #: and the kernel balances connections between them. Otherwise, workers
+    #: accept connections from one socket created by the supervisor.
+    reuse_port = False
+
+    #: Seconds to wait before restarting a worker that exits
+    restart_delay = 1.0
+
+    def __init__(self, make_factory, workers=None):
+        self.make_factory = make_factory
+        self.workers = workers or os.cpu_count() or 1
+        self.logger = logging.getLogger("quarry.net.supervisor")
+        self.context = multiprocessing.get_context("spawn")
+        self.counts = self.context.Array("i", self.workers)
+        self.processes = [None] * self.workers
+        self.running = False
+
+    def run(self, host, port=25565):
+        """
+        Starts the workers and supervises them until interrupted.
+        """
+
+        sock = None if self.reuse_port else make_socket(host, port)
+        self.running = True
+
+        def _stop(signum, frame):
+            self.running = False
+
+        previous = signal.signal(signal.SIGTERM, _stop)
+        try:
+            for index in range(self.workers):
+                self.start_worker(index, host, port, sock)
+
+            while self.running:
+                sentinels = [p.sentinel for p in self.processes]
+                ready = multiprocessing.connection.wait(sentinels, 1.0)
+                for index, process in enumerate(self.processes):
+                    if process.sentinel in ready and self.running:
+                        self.logger.warning(
+                            "Worker %d exited with code %s; restarting",
+                            index, process.exitcode)
+                        time.sleep(self.restart_delay)
+                        self.start_worker(index, host, port, sock)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            self.running = False
+            self.stop()
+            if sock is not None:
+                sock.close()
+
+    def start_worker(self, index, host, port, sock):
+        """
+        Starts (or restarts) the worker with the given index.
+        """
+
+        # Players on a dead worker are gone
+        with self.counts.get_lock():
+            self.counts[index] = 0
+
+        process = self.context.Process(
+            target=run_worker,
+            args=(self.make_factory, index, self.counts, host, port, sock),
+            name="quarry-worker-%d" % index,
+            daemon=True)
+        process.start()
+        self.processes[index] = process
+
+    def stop(self):
+        """
+        Terminates all workers.
+        """
+
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
@@ -1,25 +1,187 @@
-from twisted.internet.task import LoopingCall
+import collections
+import logging
+import math
+import random
+import time
+
+from twisted.internet import reactor
+from twisted.internet.task import Clock, LoopingCall
+
+
+#: Task priorities. Within a tick, tasks run in priority order; when the
+#: scheduler's tick budget is exhausted, low-priority loops are deferred.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class TickStats(object):
+    """
+    Rolling tick timing statistics. Records the time spent on each tick, the
+    number of ticks skipped because the scheduler fell behind, and the
+    cumulative cost of each task, keyed by its callback's qualified name.
+    Statistics may be chained to a parent, which receives everything
+    recorded by its children.
+    """
+
+    #: Number of ticks kept in the rolling window
+    window_size = 1200
+
+    def __init__(self, parent=None, window_size=None):
+        self.parent = parent
+        if window_size is not None:
+            self.window_size = window_size
+
+        #: Duration of each recent tick, in seconds, oldest first
+        self.durations = collections.deque(maxlen=self.window_size)
+
+        #: Number of ticks recorded, including those no longer in
+        #: :attr:`durations`
+        self.ticks = 0
+
+        #: Number of ticks skipped
+        self.skipped = 0
+
+        #: Dict mapping task names to ``[calls, seconds]`` lists
+        self.tasks = {}
+
+        self._tick = None
+        self._cost = 0.0
+
+    def record_tick(self, duration):
+        """
+        Records the duration of a tick, in seconds.
+        """
+        self.durations.append(duration)
+        self.ticks += 1
+
+    def record_skipped(self, count):
+        """
+        Records a number of skipped ticks.
+        """
+        self.skipped += count
+        if self.parent is not None:
+            self.parent.record_skipped(count)
+
+    def record_task(self, name, tick, cost):
+        """
+        Records the cost, in seconds, of running a task on the given tick.
+        The tick's total is added to :attr:`durations` once a later tick is
+        recorded.
+        """
+        if tick != self._tick:
+            if self._tick is not None:
+                self.durations.append(self._cost)
+                self.ticks += 1
+            self._tick = tick
+            self._cost = 0.0
+        self._cost += cost
+
+        entry = self.tasks.get(name)
+        if entry is None:
+            entry = self.tasks[name] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += cost
+
+        if self.parent is not None:
+            self.parent.record_task(name, tick, cost)
+
+    def get_mspt(self, percentile=None):
+        """
+        Returns milliseconds per tick over the rolling window: the mean if
+        no percentile is given, or else the given percentile (0-100), by
+        nearest rank.
+        """
+        if not self.durations:
+            return 0.0
+        if percentile is None:
+            return 1000.0 * sum(self.durations) / len(self.durations)
+        durations = sorted(self.durations)
+        rank = int(math.ceil(percentile / 100.0 * len(durations)))
+        return 1000.0 * durations[min(max(rank, 1), len(durations)) - 1]
+
+    def get_percentiles(self, percentiles=(50, 95, 99)):
+        """
+        Returns a dict mapping each percentile to milliseconds per tick.
+        """
+        return dict((p, self.get_mspt(p)) for p in percentiles)
+
+    def get_task_costs(self):
+        """
+        Returns a list of ``(name, calls, seconds)`` tuples, costliest first.
+        """
+        return sorted(((name, calls, seconds)
+                       for name, (calls, seconds) in self.tasks.items()),
+                      key=lambda entry: entry[2], reverse=True)
+
+    def reset(self):
+        """
+        Clears all recorded statistics.
+        """
+        self.durations.clear()
+        self.ticks = 0
+        self.skipped = 0
+        self.tasks.clear()
+        self._tick = None
+        self._cost = 0.0
 
 
 class Task(object):
     ticker = None
+    priority = PRIORITY_NORMAL
+
+    # The wheel bucket currently holding this task, if any
+    bucket = None
 
     def stop(self):
         self.ticker.remove(self)
 
+    def defer(self, tick):
+        return False
+
 
 class LoopTask(Task):
-    def __init__(self, ticker, interval, callback):
+    # Tick on which a deferred run was originally due
+    due = None
+
+    def __init__(self, ticker, interval, callback, priority=PRIORITY_NORMAL,
+                 phase=0):
         self.ticker = ticker
         self.interval = interval
         self.callback = callback
+        self.priority = priority
+        self.phase = phase % interval
 
-    def update(self):
-        if self.ticker.tick % self.interval == 0:
-            self.callback()
+    def next_tick(self, tick):
+        # Run on ticks that are equal to the phase, modulo the interval
+        return tick + (self.phase - tick) % self.interval
+
+    def schedule(self):
+        ticker = self.ticker
+        tick = max(ticker.tick,
+                   ticker.scheduler.last_tick + 1 - ticker.origin)
+        ticker.schedule(self, self.next_tick(tick))
+
+    def fire(self, tick):
+        self.due = None
+        self.callback()
+        self.ticker.schedule(self, self.next_tick(tick + 1))
+
+    def defer(self, tick):
+        # Low-priority loops may slip, but not past their next run
+        if self.priority < PRIORITY_LOW:
+            return False
+        if self.due is None:
+            self.due = tick
+        if tick + 1 - self.due >= self.interval:
+            return False
+        self.ticker.schedule(self, tick + 1)
+        return True
 
 
 class DelayTask(Task):
+    target = 0
+
     def __init__(self, ticker, delay, callback):
         self.ticker = ticker
         self.delay = delay
@@ -27,59 +189,409 @@ class DelayTask(Task):
         self.restart()
 
     def restart(self):
-        self.target = self.ticker.tick + self.delay
+        # The wheel entry isn't moved; if it fires early, it's rescheduled.
+        self.target = int(math.ceil(self.ticker.tick + self.delay))
 
-    def update(self):
-        if self.ticker.tick >= self.target:
+    def schedule(self):
+        self.ticker.schedule(self, self.target)
+
+    def fire(self, tick):
+        if tick < self.target:
+            self.ticker.schedule(self, self.target)
+        else:
             self.callback()
             self.stop()
 
 
-class Ticker(object):
+class Timer(Task):
+    """
+    A delay that runs on a scheduler directly rather than on a ticker, so it
+    can be set without starting a ticker. It keeps the scheduler running
+    until it fires or is stopped.
+    """
+
+    def __init__(self, scheduler, delay, callback):
+        self.scheduler = scheduler
+        self.delay = delay
+        self.callback = callback
+        self.active = True
+        scheduler.attach()
+        self.restart()
+        self.schedule()
+
+    def restart(self):
+        # As with DelayTask, the wheel entry isn't moved.
+        self.target = int(math.ceil(self.scheduler.tick + self.delay))
+
+    def schedule(self):
+        self.scheduler.schedule(self, self.target)
+
+    def fire(self, tick):
+        if tick < self.target:
+            self.schedule()
+        else:
+            self.stop()
+            try:
+                self.callback()
+            except Exception as e:
+                self.scheduler._logger.exception(e)
+
+    def stop(self):
+        if self.active:
+            self.active = False
+            self.scheduler.cancel(self)
+            self.scheduler.detach()
+
+
+class Scheduler(object):
+    """
+    A hierarchical timing wheel shared by every :class:`Ticker` with the
+    same clock and interval. Tasks are placed in a bucket for the tick on
+    which they next run, so insertion and cancellation are O(1) and dormant
+    tasks cost nothing until they're due.
+    """
+
+    #: Interval between ticks, in seconds
+    interval = 1.0/20
+
+    #: Maximum number of delayed ticks before they're all skipped
+    max_lag = 40
+
+    #: Number of bits of the tick number covered by each wheel
+    wheel_bits = (8, 6, 6, 6)
+
+    #: Time budget per tick, in seconds. Once a tick's tasks have used this
+    #: much time, its remaining low-priority loops are deferred to the next
+    #: tick. ``None`` means no budget.
+    tick_budget = None
+
     #: The current tick
     tick = 0
 
-    #: Interval between ticks, in seconds
+    #: The tick whose tasks are running, or ran most recently
+    last_tick = -1
+
+    running = False
+
+    def __init__(self, clock=reactor, interval=None, max_lag=None):
+        self._clock = clock
+        if interval is not None:
+            self.interval = interval
+        if max_lag is not None:
+            self.max_lag = max_lag
+        self._logger = logging.getLogger("quarry.net.ticker")
+        self._wheels = [[{} for _ in range(1 << bits)]
+                        for bits in self.wheel_bits]
+        self._shifts = []
+        shift = 0
+        for bits in self.wheel_bits:
+            self._shifts.append(shift)
+            shift += bits
+        self._horizon = 1 << shift
+        self._tickers = 0
+
+        #: A :class:`TickStats` recording the duration of every tick
+        self.stats = TickStats()
+
+        self._impl = LoopingCall.withCount(self._update)
+        self._impl.clock = clock
+
+    def attach(self):
+        """
+        Registers a running ticker, starting the tick loop if needed.
+        """
+        self._tickers += 1
+        if not self.running:
+            self._impl.start(self.interval, now=False)
+            self.running = True
+
+    def detach(self):
+        """
+        Unregisters a ticker, stopping the tick loop if none remain.
+        """
+        self._tickers -= 1
+        if self._tickers <= 0 and self.running:
+            self._tickers = 0
+            self._impl.stop()
+            self.running = False
+
+    def schedule(self, task, target):
+        """
+        Schedules a task to fire on the given (absolute) tick.
+        """
+
+        self.cancel(task)
+
+        # Never schedule into a bucket that has already been taken
+        if target <= self.last_tick:
+            target = self.last_tick + 1
+
+        # Tasks beyond the outermost wheel are parked at its far end, and
+        # rescheduled when they cascade down.
+        delta = min(target - self.tick, self._horizon - 1)
+        slot = self.tick + delta
+        for wheel, bits, shift in zip(
+                self._wheels, self.wheel_bits, self._shifts):
+            if delta < 1 << (bits + shift):
+                break
+        bucket = wheel[(slot >> shift) & ((1 << bits) - 1)]
+        bucket[task] = target
+        task.bucket = bucket
+
+    def cancel(self, task):
+        """
+        Removes a task from the wheel.
+        """
+
+        if task.bucket is not None:
+            task.bucket.pop(task, None)
+            task.bucket = None
+
+    def advance(self):
+        """
+        Runs all tasks due on the current tick, then moves to the next tick.
+        """
+
+        tick = self.tick
+
+        # Move tasks down from outer wheels as the inner wheel wraps
+        for level in range(1, len(self._wheels)):
+            shift = self._shifts[level]
+            if tick & ((1 << shift) - 1):
+                break
+            bits = self.wheel_bits[level]
+            bucket = self._wheels[level][(tick >> shift) & ((1 << bits) - 1)]
+            if bucket:
+                entries = list(bucket.items())
+                bucket.clear()
+                for task, target in entries:
+                    task.bucket = None
+                    self.schedule(task, target)
+
+        bucket = self._wheels[0][tick & ((1 << self.wheel_bits[0]) - 1)]
+        self.last_tick = tick
+        if bucket:
+            entries = list(bucket.items())
+            bucket.clear()
+
+            budget = self.tick_budget
+            if budget is not None:
+                entries.sort(key=lambda entry: entry[0].priority)
+                deadline = time.perf_counter() + budget
+            for task, target in entries:
+                task.bucket = None
+                if target > tick:
+                    self.schedule(task, target)
+                    continue
+                ticker = task.ticker
+                local_tick = tick if ticker is None else tick - ticker.origin
+                if budget is not None and \
+                        time.perf_counter() > deadline and \
+                        task.defer(local_tick):
+                    continue
+                task.fire(local_tick)
+        self.tick = tick + 1
+
+    def _update(self, count):
+        if count >= self.max_lag:
+            self._logger.warning(
+                "Can't keep up! Skipping %d ticks" % (count - 1))
+            self.stats.record_skipped(count - 1)
+            count = 1
+
+        for _ in range(count):
+            start = time.perf_counter()
+            self.advance()
+            self.stats.record_tick(time.perf_counter() - start)
+
+
+class VirtualScheduler(Scheduler):
+    """
+    A scheduler for clocks other than the reactor, such as
+    :class:`twisted.internet.task.Clock` or an asyncio event loop. The number
+    of ticks to run is derived from the clock's time rather than from the
+    loop's call count, so advancing a virtual clock in steps of
+    :attr:`interval` runs exactly one tick per step, without drifting from
+    floating point error.
+    """
+
+    _epoch_time = 0.0
+    _epoch_tick = 0
+
+    def attach(self):
+        if not self.running:
+            self._epoch_time = self._clock.seconds()
+            self._epoch_tick = self.tick
+        Scheduler.attach(self)
+
+    def _update(self, count):
+        elapsed = self._clock.seconds() - self._epoch_time
+        due = int(elapsed / self.interval + 1e-6)
+        Scheduler._update(self, self._epoch_tick + due - self.tick)
+
+        # Forget any skipped ticks
+        self._epoch_tick = self.tick - due
+
+
+_default_schedulers = {}
+
+
+def get_scheduler(clock=None, interval=None, max_lag=None):
+    """
+    Returns the :class:`Scheduler` shared by all tickers with the given
+    clock, interval and maximum lag, creating it if needed. If a clock other
+    than the reactor is given, the scheduler is a :class:`VirtualScheduler`.
+    """
+
+    if interval is None:
+        interval = Scheduler.interval
+    if max_lag is None:
+        max_lag = Scheduler.max_lag
+    key = (interval, max_lag)
+
+    if clock is None or clock is reactor:
+        schedulers = _default_schedulers
+        scheduler_type = Scheduler
+        clock = reactor
+    else:
+        # Kept on the clock, so they're released along with the clock
+        schedulers = getattr(clock, "_quarry_schedulers", None)
+        if schedulers is None:
+            schedulers = clock._quarry_schedulers = {}
+        scheduler_type = VirtualScheduler
+
+    scheduler = schedulers.get(key)
+    if scheduler is None:
+        scheduler = schedulers[key] = scheduler_type(clock, interval, max_lag)
+    return scheduler
+
+
+class Ticker(object):
+    #: Interval between ticks, in seconds. Tickers with the same interval
+    #: and :attr:`max_lag` share a scheduler.
     interval = 1.0/20
 
     #: Maximum number of delayed ticks before they're all skipped
     max_lag = 40
 
+    #: Number of tick durations kept by each ticker's :attr:`stats`. By
+    #: default none are kept, as the scheduler and the factory's aggregate
+    #: stats already record them; only cumulative task costs are.
+    stats_window_size = 0
+
+    #: Whether loops run on a random phase of their interval by default, so
+    #: that loops added by many connections at once don't all run on the
+    #: same tick
+    jitter = False
+
     running = False
 
-    def __init__(self, logger):
+    # Scheduler tick corresponding to this ticker's tick 0
+    origin = 0
+
+    def __init__(self, logger, scheduler=None):
         self._logger = logger
-        self._tasks = []
-        self._impl = LoopingCall.withCount(self._update)
+        self._tasks = {}
+        self._scheduler = scheduler
+        self._stopped_tick = 0
+        if scheduler is not None:
+            self.interval = scheduler.interval
+            self.max_lag = scheduler.max_lag
+
+        #: A :class:`TickStats` recording the cost of this ticker's tasks.
+        #: Its durations, if :attr:`stats_window_size` is set, are the time
+        #: spent on this ticker's tasks in each tick on which any ran.
+        #: Process-wide tick durations and skipped ticks are recorded by the
+        #: scheduler's stats.
+        self.stats = TickStats(window_size=self.stats_window_size)
+
+    @classmethod
+    def get_clock(cls):
+        """
+        Returns the clock that drives tickers of this type.
+        """
+        return reactor
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            self._scheduler = get_scheduler(
+                self.get_clock(), self.interval, self.max_lag)
+        return self._scheduler
+
+    @property
+    def tick(self):
+        """
+        The current tick
+        """
+        if self.running:
+            return self.scheduler.tick - self.origin
+        return self._stopped_tick
+
+    @tick.setter
+    def tick(self, tick):
+        if self.running:
+            self.origin = self.scheduler.tick - tick
+            for task in self._tasks:
+                task.schedule()
+        else:
+            self._stopped_tick = tick
 
     def start(self):
         """
         Start running the tick loop.
         """
         if not self.running:
-            self._impl.start(self.interval, now=False)
+            self.origin = self.scheduler.tick - self._stopped_tick
             self.running = True
+            self.scheduler.attach()
+            for task in self._tasks:
+                task.schedule()
 
     def stop(self):
         """
         Stop running the tick loop.
         """
         if self.running:
-            self._impl.stop()
+            self._stopped_tick = self.tick
+            for task in self._tasks:
+                self.scheduler.cancel(task)
             self.running = False
+            self.scheduler.detach()
 
-    def add_loop(self, interval, callback):
+    def add_loop(self, interval, callback, priority=PRIORITY_NORMAL,
+                 phase=None):
         """
         Repeatedly run a callback.
 
         :param interval: The interval in ticks
         :param callback: The callback to run
+        :param priority: One of ``PRIORITY_HIGH``, ``PRIORITY_NORMAL`` or
+            ``PRIORITY_LOW``. Low-priority loops may be deferred by up to
+            ``interval - 1`` ticks when the scheduler's tick budget is spent.
+        :param phase: The tick offset within the interval on which to run.
+            Defaults to a random offset if :attr:`jitter` is set, else 0.
         :return: An instance providing a ``stop()`` method
         """
-        task = LoopTask(self, interval, self._wrap(callback))
-        self._tasks.append(task)
+        if phase is None:
+            phase = random.randrange(interval) if self.jitter else 0
+        task = LoopTask(self, interval, self._wrap(callback), priority, phase)
+        self._add(task)
         return task
 
+    @classmethod
+    def add_timer(cls, delay, callback):
+        """
+        Run a callback after a delay, on the scheduler shared by tickers of
+        this type, without creating a ticker.
+
+        :param delay: The delay in ticks
+        :param callback: The callback to run
+        :return: An instance providing ``stop()`` and ``restart()`` methods
+        """
+        return Timer(get_scheduler(cls.get_clock(), cls.interval, cls.max_lag),
+                     delay, callback)
+
     def add_delay(self, delay, callback):
         """
         Run a callback after a delay.
@@ -89,7 +601,7 @@ class Ticker(object):
         :return: An instance providing ``stop()`` and ``restart()`` methods
         """
         task = DelayTask(self, delay, self._wrap(callback))
-        self._tasks.append(task)
+        self._add(task)
         return task
 
     def remove(self, task):
@@ -98,28 +610,76 @@ class Ticker(object):
 
         :param task: The task to remove
         """
-        self._tasks.remove(task)
+        if task in self._tasks:
+            del self._tasks[task]
+            self.scheduler.cancel(task)
 
     def remove_all(self):
         """
         Removes all registered tasks, effectively cancelling them.
         """
-        del self._tasks[:]
+        for task in self._tasks:
+            self.scheduler.cancel(task)
+        self._tasks.clear()
 
-    def _update(self, count):
-        if count >= self.max_lag:
-            self._logger.warn("Can't keep up! Skipping %d ticks" % (count - 1))
-            count = 1
+    def schedule(self, task, tick):
+        """
+        Schedules a task to fire on the given tick of this ticker.
+        """
+        if self.running and task in self._tasks:
+            self.scheduler.schedule(task, self.origin + tick)
 
-        for _ in range(count):
-            for task in list(self._tasks):
-                task.update()
-            self.tick += 1
+    def _add(self, task):
+        self._tasks[task] = None
+        if self.running:
+            task.schedule()
 
     def _wrap(self, callback):
+        name = getattr(callback, "__qualname__", None) or \
+            type(callback).__qualname__
+
         def fn():
+            start = time.perf_counter()
             try:
                 callback()
             except Exception as e:
                 self._logger.exception(e)
+            self.stats.record_task(name, self.scheduler.last_tick,
+                                   time.perf_counter() - start)
         return fn
+
+
+class VirtualTicker(Ticker):
+    """
+    A ticker driven by a virtual clock rather than the reactor, for
+    simulations and benchmarks that run many ticks faster than real time.
+    Set it as a factory's ``ticker_type``, then call :meth:`advance` to run
+    ticks. Tickers of the same type share a clock; use :meth:`with_clock`
+    to create a type with its own clock.
+    """
+
+    #: The clock driving this ticker
+    clock = Clock()
+
+    @classmethod
+    def get_clock(cls):
+        return cls.clock
+
+    @classmethod
+    def with_clock(cls, clock=None):
+        """
+        Returns a subclass driven by the given clock, or by a new
+        :class:`twisted.internet.task.Clock` if none is given.
+        """
+        if clock is None:
+            clock = Clock()
+        return type(cls.__name__, (cls,), {"clock": clock})
+
+    @classmethod
+    def advance(cls, ticks=1):
+        """
+        Advances the clock by the given number of ticks, running any tasks
+        that come due.
+        """
+        for _ in range(ticks):
+            cls.clock.advance(cls.interval)
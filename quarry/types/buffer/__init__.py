@@ -2,6 +2,10 @@ class BufferUnderrun(Exception):
     pass
 
 
+class BufferLimitExceeded(Exception):
+    pass
+
+
 from quarry.types.buffer.v1_7 import Buffer1_7
 from quarry.types.buffer.v1_9 import Buffer1_9
 from quarry.types.buffer.v1_13 import Buffer1_13
@@ -12,14 +12,14 @@ class Buffer1_13(Buffer1_9):
         if not palette:
             return b""
         else:
-            return cls.pack_varint(len(palette)) + b"".join(
-                cls.pack_varint(x) for x in palette)
+            return cls.pack_varint(len(palette)) + \
+                cls.pack_varint_array(palette)
 
     def unpack_chunk_section_palette(self, value_width):
         if value_width > 8:
             return []
         else:
-            return [self.unpack_varint() for _ in range(self.unpack_varint())]
+            return self.unpack_varint_array(self.unpack_varint())
 
     # Slot --------------------------------------------------------------------
 
@@ -195,8 +195,7 @@ class Buffer1_13(Buffer1_9):
         flags = self.unpack('B')
         node['type'] = ['root', 'literal', 'argument'][flags & 0x03]
         node['executable'] = bool(flags & 0x04)
-        node['children'] = [self.unpack_varint() for _ in
-                            range(self.unpack_varint())]
+        node['children'] = self.unpack_varint_array(self.unpack_varint())
         node['redirect'] = self.unpack_varint() if flags & 0x08 else None
         node['name'] = self.unpack_string() if node['type'] != 'root' else None
 
@@ -280,9 +279,8 @@ class Buffer1_13(Buffer1_9):
             int(node['suggestions'] is not None) << 4)
         out += cls.pack('B', flags)
         out += cls.pack_varint(len(node['children']))
-
-        for child in node['children'].values():
-            out += cls.pack_varint(nodes.index(child))
+        out += cls.pack_varint_array(
+            nodes.index(child) for child in node['children'].values())
 
         if node['redirect'] is not None:
             out += cls.pack_varint(nodes.index(node['redirect']))
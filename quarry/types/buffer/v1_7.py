@@ -3,7 +3,7 @@ import string
 import struct
 import zlib
 
-from quarry.types.buffer import BufferUnderrun
+from quarry.types.buffer import BufferUnderrun, BufferLimitExceeded
 from quarry.types.registry import OpaqueRegistry
 from quarry.types.uuid import UUID
 
@@ -11,16 +11,92 @@ from quarry.types.uuid import UUID
 directions = ("down", "up", "north", "south", "west", "east")
 
 
+def _encode_varint(number):
+    """
+    Encodes a non-negative integer using 7-bit groups, least significant
+    group first.
+    """
+
+    out = bytearray()
+    while number > 0x7F:
+        out.append(number & 0x7F | 0x80)
+        number >>= 7
+    out.append(number)
+    return bytes(out)
+
+
+def _decode_varint(buff, bits):
+    """
+    Decodes a varint from the read position of *buff* and interprets it as a
+    *bits*-wide two's complement integer.
+    """
+
+    if buff._inflater is not None and buff.pos + 10 > len(buff.buff):
+        buff._inflate()
+
+    data = buff.buff
+    pos = buff.pos
+    end = len(data)
+    number = 0
+    for i in range(10):
+        if pos >= end:
+            raise BufferUnderrun()
+        b = data[pos]
+        pos += 1
+        number |= (b & 0x7F) << 7*i
+        if not b & 0x80:
+            break
+    buff.pos = pos
+
+    if number & (1 << (bits - 1)):
+        number -= 1 << bits
+
+    return number
+
+
+def _check_inflated(inflater):
+    """
+    Raises :class:`BufferLimitExceeded` if a decompressor that was limited to
+    a packet's declared length has further output pending.
+    """
+
+    if inflater.unconsumed_tail and \
+            inflater.decompress(inflater.unconsumed_tail, 1):
+        raise BufferLimitExceeded(
+            "Packet body is longer than its declared length")
+
+
+# Encodings of small non-negative varints, which make up most packet IDs,
+# lengths and palette entries.
+_varint_cache_size = 1024
+_varint_cache = tuple(_encode_varint(n) for n in range(_varint_cache_size))
+
+
 class Buffer1_7(object):
     buff = b""
     pos = 0
+    saved_pos = 0
+    _inflater = None
+    _inflated_length = 0
     registry = OpaqueRegistry(13)
 
+    #: Number of consumed bytes that may accumulate at the front of the buffer
+    #: before :meth:`save` compacts it.
+    compact_threshold = 65536
+
+    #: Limits on lengths supplied by the remote, or ``None`` for no limit.
+    #: Buffers returned by :meth:`unpack_packet` inherit these limits.
+    max_frame_size = None
+    max_uncompressed_size = None
+    max_array_length = None
+
     def __init__(self, data=None):
         if data:
             self.buff = data
 
     def __len__(self):
+        if self._inflater is not None:
+            return self._inflated_length - self.pos
         return len(self.buff) - self.pos
 
     def add(self, data):
@@ -28,6 +104,8 @@ class Buffer1_7(object):
         Add some bytes to the end of the buffer.
         """
 
+        if not isinstance(self.buff, bytearray):
+            self.buff = bytearray(self.buff)
         self.buff += data
 
     def save(self):
@@ -35,8 +113,14 @@ class Buffer1_7(object):
         Saves the buffer contents.
         """
 
-        self.buff = self.buff[self.pos:]
-        self.pos = 0
+        if self.pos and isinstance(self.buff, bytearray):
+            if self.pos == len(self.buff):
+                self.buff.clear()
+                self.pos = 0
+            elif self.pos >= self.compact_threshold:
+                del self.buff[:self.pos]
+                self.pos = 0
+        self.saved_pos = self.pos
 
     def restore(self):
         """
@@ -44,13 +128,14 @@ class Buffer1_7(object):
         called.
         """
 
-        self.pos = 0
+        self.pos = self.saved_pos
 
     def discard(self):
         """
         Discards the entire buffer contents.
         """
 
+        self._inflater = None
         self.pos = len(self.buff)
 
     def read(self, length=None):
@@ -59,19 +144,55 @@ class Buffer1_7(object):
         *length* is ``None``
         """
 
+        if self._inflater is not None and (
+                length is None or self.pos + length > len(self.buff)):
+            self._inflate()
+
         if length is None:
-            data = self.buff[self.pos:]
-            self.pos = len(self.buff)
+            end = len(self.buff)
         else:
-            if self.pos + length > len(self.buff):
+            end = self.pos + length
+            if end > len(self.buff):
                 raise BufferUnderrun()
 
-            data = self.buff[self.pos:self.pos+length]
-            self.pos += length
+        if isinstance(self.buff, bytearray):
+            with memoryview(self.buff) as view:
+                data = view[self.pos:end].tobytes()
+        else:
+            data = self.buff[self.pos:end]
+        self.pos = end
 
         return data
 
+    def _inflate(self):
+        """
+        Decompresses the remainder of a packet body that was unpacked with
+        ``lazy=True``.
+        """
+
+        inflater = self._inflater
+        self._inflater = None
+        remaining = self._inflated_length - len(self.buff)
+        if remaining > 0:
+            self.buff += inflater.decompress(
+                inflater.unconsumed_tail, remaining)
+        _check_inflated(inflater)
+
+    def check_array_length(self, length):
+        """
+        Raises :class:`BufferLimitExceeded` if *length* exceeds
+        :attr:`max_array_length`.
+        """
+
+        if self.max_array_length is not None and \
+                length > self.max_array_length:
+            raise BufferLimitExceeded(
+                f"Array length {length:d} exceeds limit of "
+                f"{self.max_array_length:d}")
+
     def hexdump(self):
+        if self._inflater is not None:
+            self._inflate()
         data = self.buff[self.pos:]
         lines = ['']
         bytes_read = 0
@@ -132,6 +253,7 @@ class Buffer1_7(object):
         Unpack an array struct. The format accepted is the same as for
         ``struct.unpack()``.
         """
+        self.check_array_length(length)
         data = self.read(struct.calcsize(">" + fmt) * length)
         return list(struct.unpack(">" + fmt * length, data))
 
@@ -180,6 +302,9 @@ class Buffer1_7(object):
         Packs a varint.
         """
 
+        if 0 <= number < _varint_cache_size and number < 1 << (max_bits - 1):
+            return _varint_cache[number]
+
         number_min = -1 << (max_bits - 1)
         number_max = +1 << (max_bits - 1)
         if not (number_min <= number < number_max):
@@ -188,29 +313,29 @@ class Buffer1_7(object):
         if number < 0:
             number += 1 << 32
 
-        out = b""
-        for i in range(10):
-            b = number & 0x7F
-            number >>= 7
-            out += cls.pack("B", b | (0x80 if number > 0 else 0))
-            if number == 0:
-                break
-        return out
+        return _encode_varint(number)
 
     def unpack_varint(self, max_bits=32):
         """
         Unpacks a varint.
         """
 
-        number = 0
-        for i in range(10):
-            b = self.unpack("B")
-            number |= (b & 0x7F) << 7*i
-            if not b & 0x80:
-                break
+        buff = self.buff
+        pos = self.pos
+        try:
+            b = buff[pos]
+        except IndexError:
+            if self._inflater is None:
+                raise BufferUnderrun()
+            self._inflate()
+            return self.unpack_varint(max_bits)
+
+        # Single-byte fast path
+        if b < 0x80 and max_bits >= 8:
+            self.pos = pos + 1
+            return b
 
-        if number & (1 << 31):
-            number -= 1 << 32
+        number = _decode_varint(self, 32)
 
         number_min = -1 << (max_bits - 1)
         number_max = +1 << (max_bits - 1)
@@ -219,38 +344,143 @@ class Buffer1_7(object):
 
         return number
 
+    @classmethod
+    def pack_varint_array(cls, array, max_bits=32):
+        """
+        Packs a sequence of varints. No length prefix is written.
+        """
+
+        pack_varint = cls.pack_varint
+        return b"".join([pack_varint(number, max_bits) for number in array])
+
+    def unpack_varint_array(self, length, max_bits=32):
+        """
+        Unpacks *length* varints and returns them as a list.
+        """
+
+        self.check_array_length(length)
+        buff = self.buff
+        end = len(buff)
+        out = []
+        append = out.append
+        for _ in range(length):
+            pos = self.pos
+            if pos < end and buff[pos] < 0x80 and max_bits >= 8:
+                self.pos = pos + 1
+                append(buff[pos])
+            else:
+                append(self.unpack_varint(max_bits))
+                buff = self.buff
+                end = len(buff)
+        return out
+
+    # Varlong -----------------------------------------------------------------
+
+    @classmethod
+    def pack_varlong(cls, number, max_bits=64):
+        """
+        Packs a varlong.
+        """
+
+        if 0 <= number < _varint_cache_size and number < 1 << (max_bits - 1):
+            return _varint_cache[number]
+
+        number_min = -1 << (max_bits - 1)
+        number_max = +1 << (max_bits - 1)
+        if not (number_min <= number < number_max):
+            raise ValueError(f"varlong does not fit in range: {number_min:d} <= {number:d} < {number_max:d}")
+
+        if number < 0:
+            number += 1 << 64
+
+        return _encode_varint(number)
+
+    def unpack_varlong(self, max_bits=64):
+        """
+        Unpacks a varlong.
+        """
+
+        number = _decode_varint(self, 64)
+
+        number_min = -1 << (max_bits - 1)
+        number_max = +1 << (max_bits - 1)
+        if not (number_min <= number < number_max):
+            raise ValueError(f"varlong does not fit in range: {number_min:d} <= {number:d} < {number_max:d}")
+
+        return number
+
     # Packet ------------------------------------------------------------------
 
     @classmethod
-    def pack_packet(cls, data, compression_threshold=-1):
+    def pack_packet(cls, data, compression_threshold=-1,
+                    compression_level=-1,
+                    compression_strategy=zlib.Z_DEFAULT_STRATEGY):
         """
         Packs a packet frame. This method handles length-prefixing and
-        compression.
+        compression. The compression level and strategy are as accepted by
+        ``zlib.compressobj()``.
         """
 
         if compression_threshold >= 0:
             # Compress data and prepend uncompressed data length
             if len(data) >= compression_threshold:
-                data = cls.pack_varint(len(data)) + zlib.compress(data)
+                if compression_strategy == zlib.Z_DEFAULT_STRATEGY:
+                    compressed = zlib.compress(data, compression_level)
+                else:
+                    compressor = zlib.compressobj(
+                        compression_level, zlib.DEFLATED, zlib.MAX_WBITS,
+                        zlib.DEF_MEM_LEVEL, compression_strategy)
+                    compressed = compressor.compress(data) + compressor.flush()
+                data = cls.pack_varint(len(data)) + compressed
             else:
                 data = cls.pack_varint(0) + data
 
         # Prepend packet length
         return cls.pack_varint(len(data), max_bits=32) + data
 
-    def unpack_packet(self, cls, compression_threshold=-1):
+    def unpack_packet(self, cls, compression_threshold=-1, lazy=False):
         """
         Unpacks a packet frame. This method handles length-prefixing and
-        compression.
-        """
-        body = self.read(self.unpack_varint(max_bits=32))
+        compression. If *lazy* is true, only the first few bytes of a
+        compressed body are decompressed up front; the remainder is
+        decompressed when it is first read, or never if the returned buffer
+        is discarded.
+        """
+        length = self.unpack_varint(max_bits=32)
+        if self.max_frame_size is not None and length > self.max_frame_size:
+            raise BufferLimitExceeded(
+                f"Packet length {length:d} exceeds limit of "
+                f"{self.max_frame_size:d}")
+
+        body = self.read(length)
         buff = cls(body)
         if compression_threshold >= 0:
             uncompressed_length = buff.unpack_varint()
+            if self.max_uncompressed_size is not None and \
+                    uncompressed_length > self.max_uncompressed_size:
+                raise BufferLimitExceeded(
+                    f"Uncompressed packet length {uncompressed_length:d} "
+                    f"exceeds limit of {self.max_uncompressed_size:d}")
+
             if uncompressed_length > 0:
-                body = zlib.decompress(buff.read())
+                # Never inflate beyond the declared length
+                inflater = zlib.decompressobj()
+                with memoryview(body) as view:
+                    if lazy:
+                        body = inflater.decompress(
+                            view[buff.pos:], min(5, uncompressed_length))
+                    else:
+                        body = inflater.decompress(
+                            view[buff.pos:], uncompressed_length)
                 buff = cls(body)
-
+                if lazy and len(body) < uncompressed_length and \
+                        not inflater.eof:
+                    buff._inflater = inflater
+                    buff._inflated_length = uncompressed_length
+                else:
+                    _check_inflated(inflater)
+
+        buff.max_array_length = self.max_array_length
         return buff
 
     # String ------------------------------------------------------------------
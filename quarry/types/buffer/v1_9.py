@@ -39,8 +39,7 @@ class Buffer1_9(Buffer1_7):
 
     @classmethod
     def pack_chunk_section_palette(cls, palette):
-        return cls.pack_varint(len(palette)) + b"".join(
-            cls.pack_varint(x) for x in palette)
+        return cls.pack_varint(len(palette)) + cls.pack_varint_array(palette)
 
     @classmethod
     def pack_chunk_section_array(cls, data):
@@ -82,7 +81,7 @@ class Buffer1_9(Buffer1_7):
         return blocks, block_lights, sky_lights
 
     def unpack_chunk_section_palette(self, value_width):
-        return [self.unpack_varint() for _ in range(self.unpack_varint())]
+        return self.unpack_varint_array(self.unpack_varint())
 
     def unpack_chunk_section_array(self, value_width):
         return self.read(self.unpack_varint() * 8)
@@ -141,6 +141,7 @@ class TagList(_Tag):
     @classmethod
     def from_buff(cls, buff):
         inner_kind_id, array_length = buff.unpack('bi')
+        buff.check_array_length(array_length)
         inner_kind = _kinds[inner_kind_id]
         return cls([inner_kind.from_buff(buff) for _ in range(array_length)])
 
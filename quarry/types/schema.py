@@ -0,0 +1,163 @@
+import keyword
+import struct
+
+
+#: Field types that map to a single ``struct`` format character.
+fixed_types = "?bBhHiIqQfd"
+
+#: Field types that map to a ``(unpacker, packer)`` pair of buffer methods.
+#: A packer of ``None`` means the value is already a byte string.
+variable_types = {
+    "varint":     ("unpack_varint", "pack_varint"),
+    "varlong":    ("unpack_varlong", "pack_varlong"),
+    "string":     ("unpack_string", "pack_string"),
+    "json":       ("unpack_json", "pack_json"),
+    "chat":       ("unpack_chat", "pack_chat"),
+    "uuid":       ("unpack_uuid", "pack_uuid"),
+    "position":   ("unpack_position", "pack_position"),
+    "nbt":        ("unpack_nbt", "pack_nbt"),
+    "byte_array": ("unpack_byte_array", "pack_byte_array"),
+    "rest":       ("read", None),
+}
+
+# Field types whose packer takes the value as separate arguments
+_splat_types = {"position"}
+
+
+class Packet(object):
+    """
+    Base class for packets produced by :meth:`Schema.compile`. Subclasses
+    have one slot per field, plus ``from_buff()`` and ``to_bytes()`` methods
+    generated for a particular buffer type.
+    """
+
+    __slots__ = ()
+
+    #: The packet name, e.g. ``"handshake"``
+    name = None
+
+    #: Tuple of field names, in wire order
+    fields = ()
+
+    def __repr__(self):
+        return "<%s %s>" % (self.name, " ".join(
+            "%s=%r" % (field, getattr(self, field)) for field in self.fields))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, field) == getattr(other, field)
+            for field in self.fields)
+
+    __hash__ = None
+
+    @classmethod
+    def from_buff(cls, buff):
+        raise NotImplementedError
+
+    def to_bytes(self):
+        raise NotImplementedError
+
+
+class Schema(object):
+    """
+    Describes the payload of one packet as a sequence of ``(name, type)``
+    fields. Types are either a ``struct`` format character from
+    :data:`fixed_types` or a key of :data:`variable_types`.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = tuple(fields)
+        self._compiled = {}
+
+        for field, ty in self.fields:
+            if not field.isidentifier() or keyword.iskeyword(field) or \
+                    field.startswith("_"):
+                raise ValueError("Invalid field name: %r" % field)
+            if ty not in variable_types and not (
+                    len(ty) == 1 and ty in fixed_types):
+                raise ValueError("Unknown field type: %r" % ty)
+
+    def __repr__(self):
+        return "<Schema %s %r>" % (self.name, self.fields)
+
+    def compile(self, buff_type):
+        """
+        Returns a :class:`Packet` subclass specialized for the given buffer
+        type. Adjacent fixed-width fields are merged into a single precompiled
+        ``struct.Struct``. The result is cached.
+        """
+
+        try:
+            return self._compiled[buff_type]
+        except KeyError:
+            pass
+
+        # Group fields into runs of fixed-width fields and single
+        # variable-width fields
+        steps = []
+        for field, ty in self.fields:
+            if ty in variable_types:
+                steps.append((ty, [field]))
+            elif steps and steps[-1][0] not in variable_types:
+                steps[-1] = (steps[-1][0] + ty, steps[-1][1] + [field])
+            else:
+                steps.append((ty, [field]))
+
+        namespace = {"_new": object.__new__}
+        unpack_lines = ["def from_buff(cls, buff):",
+                        "    self = _new(cls)"]
+        pack_parts = []
+        for idx, (ty, fields) in enumerate(steps):
+            targets = ", ".join("self.%s" % field for field in fields)
+            if ty in variable_types:
+                unpacker, packer = variable_types[ty]
+                unpack_lines.append("    %s = buff.%s()" % (targets, unpacker))
+                if packer is None:
+                    pack_parts.append(targets)
+                else:
+                    namespace["_p%d" % idx] = getattr(buff_type, packer)
+                    splat = "*" if ty in _splat_types else ""
+                    pack_parts.append("_p%d(%s%s)" % (idx, splat, targets))
+            else:
+                st = struct.Struct(">" + ty)
+                namespace["_s%d" % idx] = st
+                unpack_lines.append("    %s, = _s%d.unpack(buff.read(%d))" % (
+                    targets, idx, st.size))
+                pack_parts.append("_s%d.pack(%s)" % (idx, targets))
+        unpack_lines.append("    return self")
+
+        field_names = [field for field, ty in self.fields]
+        init_lines = ["def __init__(self%s):" % "".join(
+            ", %s" % field for field in field_names)]
+        init_lines.extend("    self.%s = %s" % (field, field)
+                          for field in field_names)
+        init_lines.append("    pass")
+
+        if not pack_parts:
+            pack_expr = 'b""'
+        elif len(pack_parts) == 1:
+            pack_expr = pack_parts[0]
+        else:
+            pack_expr = 'b"".join((%s,))' % ", ".join(pack_parts)
+        pack_lines = ["def to_bytes(self):",
+                      "    return %s" % pack_expr]
+
+        source = "\n".join(unpack_lines + init_lines + pack_lines) + "\n"
+        exec(source, namespace)
+
+        cls = type(
+            "Packet_%s" % self.name,
+            (Packet,),
+            {
+                "__slots__": tuple(field_names),
+                "__init__": namespace["__init__"],
+                "from_buff": classmethod(namespace["from_buff"]),
+                "to_bytes": namespace["to_bytes"],
+                "name": self.name,
+                "fields": tuple(field_names),
+                "buff_type": buff_type,
+            })
+
+        self._compiled[buff_type] = cls
+        return cls
@@ -0,0 +1,56 @@
+import asyncio
+import gc
+import weakref
+
+from quarry.net.aio import (
+    AsyncioServerFactory, AsyncioPingClientFactory, AsyncioTicker)
+from quarry.net.protocol import Factory
+
+
+def test_ping():
+    async def main():
+        loop = asyncio.get_running_loop()
+        server_factory = AsyncioServerFactory()
+        server = await server_factory.listen("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        client_factory = AsyncioPingClientFactory()
+        await client_factory.connect("127.0.0.1", port)
+        version = await asyncio.wait_for(
+            client_factory.detected_protocol_version.asFuture(loop), 5)
+
+        server.close()
+        await server.wait_closed()
+        return version
+
+    assert asyncio.run(main()) in Factory.minecraft_versions
+
+
+def test_ticker():
+    async def main():
+        ticker = AsyncioTicker(None)
+        ticker.scheduler.interval = 0.001
+        fired = asyncio.Event()
+        ticker.add_delay(5, fired.set)
+        ticker.start()
+        await asyncio.wait_for(fired.wait(), 5)
+        ticker.stop()
+        return ticker.tick
+
+    assert asyncio.run(main()) >= 5
+
+
+def test_loop_released():
+    async def main():
+        ticker = AsyncioTicker(None)
+        ticker.start()
+        ticker.stop()
+        return ticker.scheduler
+
+    loop = asyncio.new_event_loop()
+    scheduler = loop.run_until_complete(main())
+    loop.close()
+    ref = weakref.ref(loop)
+    del loop, scheduler
+    gc.collect()
+    assert ref() is None
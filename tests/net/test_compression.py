@@ -0,0 +1,88 @@
+from twisted.internet.task import Clock
+
+from quarry.net.compression import AdaptiveCompression
+from quarry.net.protocol import Factory
+
+
+class DummyFactory(Factory):
+    compression_threshold = 256
+
+
+def advance(clock, adapter, lag):
+    clock.advance(adapter.interval + lag)
+
+
+def test_get_compression_level():
+    factory = DummyFactory()
+    factory.compression_level = 6
+    factory.packet_compression_levels = {"chunk_data": 9}
+    assert factory.get_compression_level("chat_message") == 6
+    assert factory.get_compression_level("chunk_data") == 9
+    factory.compression_level_cap = 1
+    assert factory.get_compression_level("chunk_data") == 1
+    factory.compression_level = -1
+    assert factory.get_compression_level("chat_message") == 1
+
+
+def test_adaptive_steps():
+    clock = Clock()
+    factory = DummyFactory()
+    adapter = AdaptiveCompression(factory, clock)
+    adapter.start()
+
+    # Under load: level is capped first, then the threshold rises
+    advance(clock, adapter, 0.5)
+    assert factory.compression_level_cap == 4
+    assert factory.compression_threshold == 256
+    advance(clock, adapter, 0.5)
+    assert factory.compression_level_cap == 1
+    for _ in range(10):
+        advance(clock, adapter, 0.5)
+    assert factory.compression_level_cap == 1
+    assert factory.compression_threshold == adapter.max_threshold
+
+    # Load drops: one step is undone every few calm samples
+    step = adapter.step
+    for _ in range(adapter.recover_samples):
+        advance(clock, adapter, 0)
+    assert adapter.step == step - 1
+
+    adapter.stop()
+    assert factory.compression_level_cap is None
+    assert factory.compression_threshold == 256
+
+
+def test_adaptive_steps_disabled():
+    factory = DummyFactory()
+    factory.compression_threshold = -1
+    adapter = AdaptiveCompression(factory, Clock())
+    assert adapter.steps == [(None, -1), (4, -1), (1, -1)]
+
+    factory.compression_threshold = 0
+    adapter = AdaptiveCompression(factory, Clock())
+    assert adapter.steps == [(None, 0), (4, 0), (1, 0)]
+
+    factory.compression_threshold = 32
+    adapter = AdaptiveCompression(factory, Clock())
+    assert [threshold for level, threshold in adapter.steps] == [
+        32, 32, 32, 64, 128, 256, 512, 1024, 2048, 4096]
+
+
+def test_adaptive_tick_lag():
+    clock = Clock()
+    factory = DummyFactory()
+    stats = factory.get_tick_stats()
+    adapter = AdaptiveCompression(factory, clock)
+    adapter.start()
+
+    # Slow ticks count as lag even if the reactor keeps up
+    for tick in range(21):
+        stats.record_task("Dummy.update", tick, 0.08)
+    advance(clock, adapter, 0)
+    assert adapter.step == 1
+
+    for tick in range(21, 42):
+        stats.record_task("Dummy.update", tick, 0.001)
+    advance(clock, adapter, 0)
+    assert adapter.step == 1
+    adapter.stop()
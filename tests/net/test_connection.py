@@ -0,0 +1,85 @@
+import pytest
+
+from quarry.net.connection import Connection, ProtocolError
+
+key = b"0123456789abcdef"
+
+
+def make_pair(protocol_version=760):
+    client = Connection("downstream", "upstream", protocol_version)
+    server = Connection("upstream", "downstream", protocol_version)
+    return client, server
+
+
+def transfer(a, b):
+    b.receive_data(a.data_to_send())
+    received = []
+    while True:
+        packet = b.next_packet()
+        if packet is None:
+            return received
+        received.append(packet)
+
+
+def test_handshake():
+    client, server = make_pair()
+    client.send_packet("handshake", client.pack_fields(
+        "handshake", protocol_version=760, connect_host="localhost",
+        connect_port=25565, protocol_mode=2))
+    ((name, buff),) = transfer(client, server)
+    assert name == "handshake"
+    assert server.unpack_fields(buff, name).connect_host == "localhost"
+
+
+def test_partial():
+    client, server = make_pair()
+    client.protocol_mode = server.protocol_mode = "status"
+    client.send_packet("status_request")
+    client.send_packet("status_ping", client.buff_type.pack("Q", 1234))
+    data = client.data_to_send()
+
+    server.receive_data(data[:3])
+    assert server.next_packet()[0] == "status_request"
+    assert server.next_packet() is None
+    server.receive_data(data[3:])
+    name, buff = server.next_packet()
+    assert name == "status_ping"
+    assert buff.unpack("Q") == 1234
+
+
+def test_compression_encryption():
+    client, server = make_pair()
+    for connection in (client, server):
+        connection.protocol_mode = "play"
+        connection.compression_threshold = 64
+        connection.cipher.enable(key)
+
+    payload = client.buff_type.pack_string("x" * 1000)
+    server.send_packet("chat_message", payload)
+    assert server.outgoing_size < len(payload)
+    server.send_packet("keep_alive", server.buff_type.pack("q", 7))
+    received = transfer(server, client)
+    assert [name for name, buff in received] == ["chat_message", "keep_alive"]
+    assert received[0][1].unpack_string() == "x" * 1000
+
+
+def test_frames_to_send():
+    client, server = make_pair()
+    client.protocol_mode = "status"
+    client.send_packet("status_request")
+    client.send_packet("status_request")
+    assert client.frames_to_send() == [b"\x01\x00", b"\x01\x00"]
+    assert client.frames_to_send() == []
+
+    # Encrypted frames are joined
+    client.cipher.enable(key)
+    client.send_packet("status_request")
+    client.send_packet("status_request")
+    assert len(client.frames_to_send()) == 1
+
+
+def test_unknown_packet():
+    client, server = make_pair()
+    server.receive_data(b"\x01\x7f")
+    with pytest.raises(ProtocolError):
+        server.next_packet()
@@ -0,0 +1,68 @@
+import time
+
+from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.hazmat.primitives.hashes import SHA1
+
+from quarry.net import crypto
+from quarry.net.auth import PlayerPublicKey
+from quarry.types.uuid import UUID
+
+
+def make_public_key(signing_key, uuid, expiry):
+    key = crypto.make_keypair().public_key()
+    key_bytes = key.public_bytes(
+        crypto.Encoding.DER, crypto.PublicFormat.SubjectPublicKeyInfo)
+    signature = signing_key.sign(
+        uuid.bytes + expiry.to_bytes(8, 'big') + key_bytes,
+        PKCS1v15(), SHA1())
+    return PlayerPublicKey(expiry, key, signature)
+
+
+def test_verified_key_cache():
+    cache = crypto.VerifiedKeyCache(max_size=2)
+    uuid = UUID.random()
+    keys = [PlayerPublicKey(1000 + i, None, b"sig%d" % i) for i in range(3)]
+
+    cache.add(uuid, keys[0], b"key0", now=0)
+    assert cache.contains(uuid, keys[0], b"key0", now=0)
+    assert not cache.contains(uuid, keys[0], b"other", now=0)
+    assert not cache.contains(UUID.random(), keys[0], b"key0", now=0)
+
+    # Least recently used entry is evicted
+    cache.add(uuid, keys[1], b"key1", now=0)
+    cache.contains(uuid, keys[0], b"key0", now=0)
+    cache.add(uuid, keys[2], b"key2", now=0)
+    assert len(cache) == 2
+    assert cache.contains(uuid, keys[0], b"key0", now=0)
+    assert not cache.contains(uuid, keys[1], b"key1", now=0)
+
+    # Expired entries are evicted
+    assert not cache.contains(uuid, keys[0], b"key0", now=1001)
+    assert len(cache) == 1
+    cache.add(uuid, keys[1], b"key1", now=2000)
+    assert len(cache) == 1
+
+
+def test_verify_mojang_v2_signature_cached(monkeypatch):
+    signing_key = crypto.make_keypair()
+    monkeypatch.setattr(crypto, "_yggdrasil_key", signing_key.public_key())
+    monkeypatch.setattr(crypto, "verified_keys", crypto.VerifiedKeyCache())
+
+    uuid = UUID.random()
+    expiry = int(time.time() * 1000) + 60000
+    data = make_public_key(signing_key, uuid, expiry)
+
+    assert crypto.verify_mojang_v2_signature(data, uuid)
+    assert len(crypto.verified_keys) == 1
+
+    # A cached signature doesn't validate a different key
+    forged = PlayerPublicKey(
+        expiry, crypto.make_keypair().public_key(), data.signature)
+    assert not crypto.verify_mojang_v2_signature(forged, uuid)
+    assert not crypto.verify_mojang_v2_signature(data, UUID.random())
+
+    def fail(*args):
+        raise AssertionError("signature checked again")
+
+    monkeypatch.setattr(crypto, "get_yggdrasil_session_key", fail)
+    assert crypto.verify_mojang_v2_signature(data, uuid)
@@ -0,0 +1,77 @@
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.python import failure
+from twisted.web.client import ResponseDone
+
+from quarry.net.http import HTTPClient, HTTPException
+
+
+class FakeResponse(object):
+    code = 200
+    phrase = b"OK"
+
+    def __init__(self, body):
+        self.body = body
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(ResponseDone()))
+
+
+class FakeAgent(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, body=None):
+        d = defer.Deferred()
+        self.requests.append((method, url, d))
+        return d
+
+
+def make_client():
+    client = HTTPClient(Clock())
+    client.agent = FakeAgent()
+    return client
+
+
+def test_coalesce():
+    client = make_client()
+    results = []
+    for i in range(2):
+        client.request(b"https://a/x", 10).addCallback(results.append)
+    client.request(b"https://a/y", 10).addCallback(results.append)
+    assert len(client.agent.requests) == 2
+
+    client.agent.requests[0][2].callback(FakeResponse(b'{"id": 1}'))
+    assert results == [{"id": 1}, {"id": 1}]
+    assert results[0] is not results[1]
+    assert len(client.in_flight) == 1
+
+    # Finished requests aren't reused
+    client.request(b"https://a/x", 10)
+    assert len(client.agent.requests) == 3
+
+
+def test_timeout():
+    client = make_client()
+    errors = []
+    client.request(b"https://a/x", 10, HTTPException).addErrback(
+        errors.append)
+    client.clock.advance(9)
+    assert errors == []
+    client.clock.advance(1)
+    assert errors[0].value.error_type == "Timeout"
+    assert client.in_flight == {}
+
+
+def test_connections_per_host():
+    client = make_client()
+    client.max_connections_per_host = 1
+    client.request(b"https://a/x", 10)
+    client.request(b"https://a/y", 10)
+    client.request(b"https://b/x", 10)
+    assert [r[1] for r in client.agent.requests] == [
+        b"https://a/x", b"https://b/x"]
+
+    client.agent.requests[0][2].callback(FakeResponse(b""))
+    assert [r[1] for r in client.agent.requests][-1] == b"https://a/y"
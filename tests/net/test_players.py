@@ -0,0 +1,113 @@
+from quarry.net.players import PlayerIndex, SpatialIndex
+from quarry.net.server import ServerFactory
+from quarry.types.uuid import UUID
+
+
+class DummyPlayer(object):
+    closed = False
+    protocol_mode = "play"
+    protocol_version = 760
+    compression_threshold = -1
+    send_direction = "downstream"
+
+    def __init__(self, display_name, protocol_version=760):
+        self.display_name = display_name
+        self.protocol_version = protocol_version
+        self.uuid = UUID.from_offline_player(display_name)
+        self.frames = []
+
+    def pack_frame(self, name, data):
+        return data
+
+    def log_packet(self, prefix, name):
+        pass
+
+    def send_frame(self, frame):
+        self.frames.append(frame)
+
+
+def test_lookup():
+    index = PlayerIndex()
+    alice, bob = DummyPlayer("Alice"), DummyPlayer("Bob")
+    index.add(alice)
+    index.add(bob)
+    assert len(index) == 2
+    assert index.get_by_uuid(alice.uuid) is alice
+    assert index.get_by_name("ALICE") is alice
+    assert index.get_by_name("carol") is None
+
+    # A reconnecting player replaces their old connection
+    alice2 = DummyPlayer("alice")
+    index.add(alice2)
+    assert index.get_by_name("Alice") is alice2
+    index.remove(alice)
+    assert index.get_by_uuid(alice2.uuid) is alice2
+    assert alice not in index and alice2 in index
+
+
+def test_groups():
+    index = PlayerIndex()
+    alice, bob = DummyPlayer("Alice"), DummyPlayer("Bob")
+    index.add(alice)
+    index.add(bob)
+    index.add_to_group(alice, "red")
+    index.add_to_group(bob, "red")
+    index.add_to_group(alice, ("world", "nether"))
+    assert index.get_group("red") == {alice, bob}
+    assert index.get_player_groups(alice) == {"red", ("world", "nether")}
+
+    index.remove_from_group(bob, "red")
+    assert index.get_group("red") == {alice}
+    index.remove(alice)
+    assert index.get_group("red") == set()
+    assert index.get_player_groups(alice) == set()
+
+
+def test_factory():
+    factory = ServerFactory()
+    alice, bob = DummyPlayer("Alice"), DummyPlayer("Bob")
+    for player in (alice, bob):
+        assert factory.add_player(player)
+        factory.player_index.add(player)
+    factory.player_index.add_to_group(bob, "party")
+
+    factory.broadcast("chat_message", b"hi", group="party")
+    assert alice.frames == [] and bob.frames == [b"hi"]
+
+    factory.remove_player(bob)
+    assert factory.player_index.get_by_name("bob") is None
+    assert factory.player_index.get_group("party") == set()
+
+
+def test_spatial():
+    index = SpatialIndex(view_distance=4)
+    alice, bob = DummyPlayer("Alice"), DummyPlayer("Bob", 759)
+    carol = DummyPlayer("Carol")
+    index.update(alice, 8.5, 8.5)
+    index.update(bob, -40.0, 70.0)
+    index.update(carol, 200.0, 0.0, view_distance=2)
+    assert index.get_chunk(bob) == (-3, 4)
+
+    assert set(index.get_players_in_range(0, 0)) == {alice, bob}
+    assert set(index.get_players_in_range(10, 0)) == {carol}
+    assert set(index.get_players_in_range(4, 0)) == {alice}
+    assert index.get_recipients(0, 0, exclude={alice}) == {759: [bob]}
+    assert index.get_recipients(-96, 64) == {759: [bob]}
+
+    # Moving between cells, and view distance is kept
+    index.update(carol, 90.0, 0.0)
+    assert set(index.get_players_in_range(0, 0)) == {alice, bob}
+    assert set(index.get_players_in_range(3, 0)) == {alice, carol}
+
+    index.remove(alice)
+    assert alice not in index and len(index) == 2
+    assert index.get_chunk_recipients(0, 0) == {759: [bob]}
+
+
+def test_spatial_factory():
+    factory = ServerFactory()
+    alice = DummyPlayer("Alice")
+    factory.add_player(alice)
+    factory.spatial_index.update(alice, 0, 0)
+    factory.remove_player(alice)
+    assert alice not in factory.spatial_index
@@ -0,0 +1,134 @@
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+
+from quarry.net.connection import Connection
+from quarry.net.protocol import Factory, Protocol
+from quarry.net.ticker import VirtualTicker
+
+
+class DummyProtocol(Protocol):
+    recv_direction = "upstream"
+    send_direction = "downstream"
+
+
+class DummyFactory(Factory):
+    protocol = DummyProtocol
+    ticker_type = VirtualTicker.with_clock()
+    compression_offload_size = 16
+
+    def __init__(self):
+        self.clock = Clock()
+        self.offloaded = []
+
+    def defer_to_thread(self, f, *args, **kwargs):
+        d = defer.Deferred()
+        self.offloaded.append((d, f, args))
+        return d
+
+
+def make_protocol(protocol_mode="play", compression_threshold=0):
+    factory = DummyFactory()
+    protocol = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 25565))
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.protocol_mode = protocol_mode
+    protocol.compression_threshold = compression_threshold
+    return factory, protocol, transport
+
+
+def complete(factory, index):
+    d, f, args = factory.offloaded[index]
+    d.callback(f(*args))
+
+
+def received(protocol, transport):
+    client = Connection("downstream", "upstream", protocol.protocol_version)
+    client.protocol_mode = protocol.protocol_mode
+    client.compression_threshold = protocol.compression_threshold
+    client.receive_data(transport.value())
+    payloads = []
+    while True:
+        packet = client.next_packet()
+        if packet is None:
+            return payloads
+        payloads.append(packet[1].read())
+
+
+def test_send_deferred_order():
+    factory, protocol, transport = make_protocol()
+    protocol.send_packet("keep_alive", b"a" * 20)
+    protocol.send_packet("keep_alive", b"b")
+    protocol.send_packet("keep_alive", b"c" * 20)
+    assert len(factory.offloaded) == 2
+
+    complete(factory, 1)
+    assert transport.value() == b""
+    complete(factory, 0)
+    assert received(protocol, transport) == [b"a" * 20, b"b", b"c" * 20]
+    protocol.connection_lost()
+
+
+def test_send_deferred_failure():
+    factory, protocol, transport = make_protocol()
+    protocol.send_packet("keep_alive", b"a" * 20)
+    factory.offloaded[0][0].errback(ValueError("nope"))
+    assert protocol.closed
+    assert transport.disconnecting
+    protocol.connection_lost()
+
+
+def test_send_deferred_close():
+    factory, protocol, transport = make_protocol()
+    protocol.send_packet("keep_alive", b"a" * 20)
+    protocol.close()
+    assert not transport.disconnecting
+
+    # Packets sent after closing are dropped
+    protocol.send_packet("keep_alive", b"b")
+    complete(factory, 0)
+    assert transport.disconnecting
+    assert received(protocol, transport) == [b"a" * 20]
+    protocol.connection_lost()
+
+
+def test_send_deferred_connection_lost():
+    factory, protocol, transport = make_protocol()
+    protocol.send_packet("keep_alive", b"a" * 20)
+    protocol.connection_lost()
+    complete(factory, 0)
+    assert transport.value() == b""
+
+
+def test_cork_output():
+    factory, protocol, transport = make_protocol("play", -1)
+    factory.cork_output = True
+    protocol.send_packet("keep_alive", b"a")
+    protocol.send_packet("keep_alive", b"b")
+    assert transport.value() == b""
+
+    factory.clock.advance(0)
+    assert received(protocol, transport) == [b"a", b"b"]
+    protocol.connection_lost()
+
+
+def test_cork_output_flush_size():
+    factory, protocol, transport = make_protocol("play", -1)
+    factory.cork_output = True
+    factory.cork_flush_size = 8
+    protocol.send_packet("keep_alive", b"a")
+    assert transport.value() == b""
+    protocol.send_packet("keep_alive", b"b" * 8)
+    assert received(protocol, transport) == [b"a", b"b" * 8]
+    assert not factory.clock.getDelayedCalls()
+    protocol.connection_lost()
+
+
+def test_cork_output_modes():
+    factory, protocol, transport = make_protocol("status", -1)
+    factory.cork_output = True
+    protocol.send_packet("status_response", b"a")
+    assert received(protocol, transport) == [b"a"]
+    assert not factory.clock.getDelayedCalls()
+    protocol.connection_lost()
@@ -0,0 +1,41 @@
+import pytest
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
+
+from quarry.net.protocol import Factory, Protocol
+from quarry.net.proxy import Bridge
+from quarry.net.ticker import VirtualTicker
+
+
+class DummyProtocol(Protocol):
+    recv_direction = "upstream"
+    send_direction = "downstream"
+
+
+class DummyFactory(Factory):
+    protocol = DummyProtocol
+    ticker_type = VirtualTicker.with_clock()
+
+
+def make_protocol(factory):
+    protocol = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 25565))
+    protocol.makeConnection(StringTransport())
+    protocol.protocol_mode = "status"
+    return protocol
+
+
+def test_fast_forwarding_pending():
+    factory = DummyFactory()
+    bridge = Bridge(factory, make_protocol(factory))
+    bridge.upstream = make_protocol(factory)
+
+    d = defer.Deferred()
+    bridge.upstream.send_frame_deferred(d)
+    with pytest.raises(Exception):
+        bridge.enable_fast_forwarding()
+
+    d.callback(bridge.upstream.pack_frame("status_response", b"{}"))
+    bridge.enable_fast_forwarding()
+    bridge.downstream.connection_lost()
+    bridge.upstream.connection_lost()
@@ -0,0 +1,110 @@
+import ipaddress
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+
+from quarry.net.connection import Connection
+from quarry.net.ratelimit import RateLimiter
+from quarry.net.server import ServerFactory
+
+
+class DummyLimiter(RateLimiter):
+    limits = {
+        "accept": ((1.0, 2), (1.0, 3)),
+        "login": ((1.0, 1), None),
+    }
+
+
+def test_ip_limit():
+    clock = Clock()
+    limiter = DummyLimiter(clock)
+    assert limiter.allow("accept", "10.0.0.1")
+    assert limiter.allow("accept", "10.0.0.1")
+    assert not limiter.allow("accept", "10.0.0.1")
+    assert limiter.allow("handshake", "10.0.0.1")
+
+    clock.advance(1)
+    assert limiter.allow("accept", "10.0.0.1")
+    assert not limiter.allow("accept", "10.0.0.1")
+    assert limiter.rejected == {"accept": 2}
+
+
+def test_subnet_limit():
+    clock = Clock()
+    limiter = DummyLimiter(clock)
+    assert limiter.allow("accept", "10.0.0.1")
+    assert limiter.allow("accept", "10.0.0.2")
+    assert limiter.allow("accept", "10.0.0.3")
+    assert not limiter.allow("accept", "10.0.0.4")
+    assert limiter.allow("accept", "10.0.1.1")
+    assert limiter.allow("accept", "2001:db8::1")
+
+    # A rejected event doesn't spend the address's tokens
+    clock.advance(1)
+    assert limiter.allow("accept", "10.0.0.4")
+    assert limiter.allow("login", "10.0.0.4")
+    assert not limiter.allow("login", "10.0.0.4")
+
+
+def test_mapped_subnet():
+    limiter = DummyLimiter(Clock())
+    assert limiter.get_subnet("::ffff:10.0.0.1") == \
+        ipaddress.ip_network("10.0.0.0/24")
+    assert limiter.get_subnet("2001:db8::1") == \
+        ipaddress.ip_network("2001:db8::/64")
+
+    # Mapped IPv4 peers on a dual-stack listener don't share a subnet
+    for i in range(3):
+        assert limiter.allow("accept", "::ffff:10.0.0.%d" % (i + 1))
+    assert not limiter.allow("accept", "::ffff:10.0.0.4")
+    assert limiter.allow("accept", "::ffff:10.0.1.1")
+    assert limiter.allow("accept", "::ffff:10.0.2.1")
+
+
+def test_prune():
+    clock = Clock()
+    limiter = DummyLimiter(clock)
+    limiter.allow("accept", "10.0.0.1")
+    clock.advance(0.5)
+    limiter.allow("accept", "10.0.1.1")
+    clock.advance(0.5)
+    limiter.prune()
+    assert set(key[1] for key in limiter.buckets) == {
+        "10.0.1.1", ipaddress.ip_network("10.0.1.0/24")}
+
+
+def test_factory():
+    factory = ServerFactory()
+    factory.rate_limiter = DummyLimiter(Clock())
+    addr = IPv4Address("TCP", "10.0.0.1", 25565)
+    assert factory.buildProtocol(addr) is not None
+    assert factory.buildProtocol(addr) is not None
+    assert factory.buildProtocol(addr) is None
+    assert factory.rate_limiter.rejected["accept"] == 1
+
+
+def test_handshake():
+    class HandshakeLimiter(RateLimiter):
+        limits = {"handshake": ((1.0, 1), None)}
+
+    factory = ServerFactory()
+    factory.clock = Clock()
+    factory.rate_limiter = HandshakeLimiter(factory.clock)
+    addr = IPv4Address("TCP", "10.0.0.1", 25565)
+
+    client = Connection("downstream", "upstream", 760)
+    client.send_packet("handshake", client.pack_fields(
+        "handshake", protocol_version=760, connect_host="localhost",
+        connect_port=25565, protocol_mode=1))
+    data = client.data_to_send()
+
+    closed = []
+    for i in range(2):
+        protocol = factory.buildProtocol(addr)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.data_received(data)
+        closed.append(transport.disconnecting)
+        protocol.connection_lost()
+    assert closed == [False, True]
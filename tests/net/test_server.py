@@ -0,0 +1,257 @@
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
+
+from quarry.data import packets
+from quarry.net import crypto
+from quarry.net.connection import Connection
+from quarry.net.protocol import Factory, Protocol
+from quarry.net.server import (
+    ServerFactory, ServerProtocol, check_encryption_response)
+from quarry.net.ticker import VirtualTicker
+
+
+def test_check_encryption_response():
+    keypair = crypto.make_keypair()
+    public_key = keypair.public_key()
+    secret = crypto.make_shared_secret()
+    token = crypto.make_verify_token()
+
+    assert check_encryption_response(
+        keypair,
+        crypto.encrypt_secret(public_key, secret),
+        crypto.encrypt_secret(public_key, token),
+        token) == secret
+    assert check_encryption_response(
+        keypair,
+        crypto.encrypt_secret(public_key, secret),
+        crypto.encrypt_secret(public_key, b"nope"),
+        token) is None
+
+
+class DummyProtocol(Protocol):
+    recv_direction = "upstream"
+    send_direction = "downstream"
+
+    def setup(self):
+        self.received = []
+
+    def packet_status_request(self, buff):
+        self.received.append("status_request")
+        self.pause_receiving()
+
+    def packet_status_ping(self, buff):
+        self.received.append(buff.unpack("Q"))
+
+
+class DummyFactory(Factory):
+    protocol = DummyProtocol
+    ticker_type = VirtualTicker.with_clock()
+
+
+def test_pause_receiving():
+    factory = DummyFactory()
+    protocol = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 25565))
+    protocol.makeConnection(StringTransport())
+    protocol.protocol_mode = "status"
+    buff_type = protocol.buff_type
+
+    data = buff_type.pack_packet(buff_type.pack_varint(0)) + \
+        buff_type.pack_packet(buff_type.pack_varint(1) +
+                              buff_type.pack("Q", 1))
+    protocol.data_received(data[:3])
+    protocol.data_received(data[3:])
+    assert protocol.received == ["status_request"]
+
+    protocol.resume_receiving()
+    assert protocol.received == ["status_request", 1]
+    protocol.connection_lost()
+
+
+class StatusFactory(ServerFactory):
+    ticker_type = VirtualTicker.with_clock()
+
+
+def test_status():
+    factory = StatusFactory()
+    protocol = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 25565))
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    assert protocol.connection._recv_buff is None
+
+    client = Connection("downstream", "upstream", 760)
+    client.send_packet("handshake", client.pack_fields(
+        "handshake", protocol_version=760, connect_host="localhost",
+        connect_port=25565, protocol_mode=1))
+    client.protocol_mode = "status"
+    client.send_packet("status_request")
+    protocol.data_received(client.data_to_send())
+
+    client.receive_data(transport.value())
+    name, buff = client.next_packet()
+    assert name == "status_response"
+    status = buff.unpack_json()
+    assert status["players"] == {"online": 0, "max": 20}
+    assert status["version"]["protocol"] == 760
+
+    # Answered without a ticker, logger or cipher
+    assert protocol._ticker is None
+    assert protocol._logger is None
+    assert protocol.connection._cipher is None
+    protocol.connection_lost()
+
+
+def test_status_cache():
+    factory = StatusFactory()
+    frame = factory.get_status_response(760)
+    assert factory.get_status_response(760) is frame
+    assert factory.get_status_response(759) is not frame
+
+    factory.motd = "Changed"
+    assert factory.get_status_response(760) != frame
+    frame = factory.get_status_response(760)
+    factory.players.add(object())
+    assert factory.get_status_response(760) != frame
+
+
+def test_lazy_setup():
+    factory = StatusFactory()
+    protocols = [
+        factory.buildProtocol(IPv4Address("TCP", host, 25565))
+        for host in ("127.0.0.1", "127.0.0.2")]
+    assert protocols[0].logger.logger is protocols[1].logger.logger
+
+    protocol = protocols[0]
+    assert protocol._ticker is None
+    protocol.protocol_mode = "login"
+    assert protocol._ticker is not None
+    assert protocol.ticker.running
+    for protocol in protocols:
+        protocol.connection_lost()
+
+
+class LoginStepFactory(StatusFactory):
+    def defer_to_login_pool(self, f, *args, **kwargs):
+        return defer.maybeDeferred(f, *args, **kwargs)
+
+
+def test_defer_login_step():
+    factory = LoginStepFactory()
+    protocol = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 25565))
+    protocol.makeConnection(StringTransport())
+    protocol.protocol_mode = "login"
+    results = []
+    protocol.defer_login_step(lambda: 1, results.append)
+    assert results == [1]
+    assert protocol._recv_held is None
+    assert not protocol.closed
+
+    def fail(result):
+        raise ValueError(result)
+
+    protocol.defer_login_step(lambda: 2, fail)
+    assert protocol._recv_held is None
+    assert protocol.closed
+    protocol.connection_lost()
+
+
+def test_get_packet_name_override():
+    class RenamingProtocol(DummyProtocol):
+        def get_packet_name(self, ident):
+            if self.protocol_mode == "status" and ident == 0:
+                return "status_renamed"
+            return DummyProtocol.get_packet_name(self, ident)
+
+        def packet_status_renamed(self, buff):
+            self.received.append("status_renamed")
+
+    factory = DummyFactory()
+    factory.protocol = RenamingProtocol
+    protocol = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 25565))
+    protocol.makeConnection(StringTransport())
+    protocol.protocol_mode = "status"
+    buff_type = protocol.buff_type
+
+    protocol.data_received(
+        buff_type.pack_packet(buff_type.pack_varint(0)) +
+        buff_type.pack_packet(buff_type.pack_varint(1) +
+                              buff_type.pack("Q", 1)))
+    assert protocol.received == ["status_renamed", 1]
+    protocol.connection_lost()
+
+
+def test_dispatch():
+    factory = DummyFactory()
+    protocol = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 25565))
+    protocol.makeConnection(StringTransport())
+    protocol.packet_status_ping = lambda buff: protocol.received.append(
+        ("instance", buff.unpack("Q")))
+    buff_type = protocol.buff_type
+
+    protocol.protocol_mode = "status"
+    protocol.data_received(
+        buff_type.pack_packet(buff_type.pack_varint(1) +
+                              buff_type.pack("Q", 1)))
+    assert protocol.received == [("instance", 1)]
+
+    # The table is rebuilt for the new mode
+    protocol.protocol_mode = "login"
+    protocol.packet_login_start = lambda buff: protocol.received.append(
+        buff.unpack_string())
+    buff_type = protocol.buff_type
+    ident = packets.packet_idents[
+        (protocol.protocol_version, "login", "upstream", "login_start")]
+    protocol.data_received(
+        buff_type.pack_packet(buff_type.pack_varint(ident) +
+                              buff_type.pack_string("bob")))
+    assert protocol.received == [("instance", 1), "bob"]
+    protocol.connection_lost()
+
+
+class BroadcastProtocol(ServerProtocol):
+    def setup(self):
+        self.frames = []
+
+    def send_frame(self, data):
+        self.frames.append(data)
+
+
+class BroadcastFactory(ServerFactory):
+    protocol = BroadcastProtocol
+    ticker_type = VirtualTicker.with_clock()
+
+
+def test_broadcast():
+    factory = BroadcastFactory()
+    players = []
+    for version, mode, threshold in (
+            (760, "play", -1), (760, "play", -1), (760, "play", 256),
+            (47, "play", -1), (760, "login", -1), (760, "play", -1)):
+        player = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 0))
+        player.protocol_version = version
+        player.buff_type = factory.get_buff_type(version)
+        player.protocol_mode = mode
+        player.compression_threshold = threshold
+        players.append(player)
+
+    calls = []
+
+    def payload(buff_type, protocol_version):
+        calls.append((buff_type, protocol_version))
+        return buff_type.pack("q", protocol_version)
+
+    factory.broadcast("keep_alive", payload, players, exclude=players[5])
+    assert sorted(calls, key=lambda call: call[1]) == [
+        (factory.get_buff_type(47), 47),
+        (factory.get_buff_type(760), 760),
+        (factory.get_buff_type(760), 760)]
+
+    # Players sharing a version, mode and threshold get the same frame
+    frames = [player.frames for player in players]
+    assert [len(f) for f in frames] == [1, 1, 1, 1, 0, 0]
+    assert frames[0][0] is frames[1][0]
+    assert frames[2][0] != frames[0][0]
+    assert frames[3][0] != frames[0][0]
+
+    for player in players:
+        player.connection_lost()
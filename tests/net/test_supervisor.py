@@ -0,0 +1,34 @@
+import multiprocessing
+
+from quarry.net.server import ServerFactory
+from quarry.net.supervisor import SharedPlayerCount
+
+
+def test_shared_player_count():
+    counts = multiprocessing.Array("i", 2)
+    worker0 = SharedPlayerCount(counts, 0)
+    worker1 = SharedPlayerCount(counts, 1)
+    assert worker0.try_add(3)
+    assert worker1.try_add(3)
+    assert worker1.try_add(3)
+    assert not worker0.try_add(3)
+    assert worker0.total() == 3
+    worker1.remove()
+    assert worker0.try_add(3)
+    assert list(counts) == [2, 1]
+
+
+def test_factory_players():
+    factory = ServerFactory()
+    factory.max_players = 2
+    factory.shared_player_count = SharedPlayerCount(
+        multiprocessing.Array("i", 2), 0)
+    factory.shared_player_count.counts[1] = 1
+
+    assert factory.add_player("a")
+    assert not factory.add_player("b")
+    assert factory.get_player_count() == 2
+    factory.remove_player("a")
+    factory.remove_player("a")
+    assert factory.get_player_count() == 1
+    assert factory.players == set()
@@ -0,0 +1,296 @@
+import gc
+import logging
+import time
+import weakref
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+
+from quarry.net.protocol import Factory, Protocol
+from quarry.net.ticker import (
+    Scheduler, Ticker, TickStats, VirtualTicker, PRIORITY_HIGH, PRIORITY_LOW,
+    get_scheduler)
+
+logger = logging.getLogger("test")
+
+
+class DummyScheduler(Scheduler):
+    # Avoid accumulating floating point error in the clock
+    interval = 1
+
+
+def make_ticker():
+    clock = Clock()
+    ticker = Ticker(logger, DummyScheduler(clock))
+    return clock, ticker
+
+
+def run(clock, ticks):
+    for _ in range(ticks):
+        clock.advance(DummyScheduler.interval)
+
+
+def test_loop():
+    clock, ticker = make_ticker()
+    ticks = []
+    ticker.add_loop(5, lambda: ticks.append(ticker.tick))
+    ticker.start()
+    run(clock, 21)
+    assert ticks == [0, 5, 10, 15, 20]
+
+
+def test_loop_added_mid_tick():
+    clock, ticker = make_ticker()
+    ticks = []
+    ticker.add_loop(
+        4, lambda: ticker.add_loop(4, lambda: ticks.append(ticker.tick)))
+    ticker.start()
+    run(clock, 9)
+    assert ticks == [4, 8, 8]
+
+
+def test_loop_phase():
+    clock, ticker = make_ticker()
+    ticks = []
+    ticker.add_loop(5, lambda: ticks.append(ticker.tick), phase=3)
+    ticker.start()
+    run(clock, 14)
+    assert ticks == [3, 8, 13]
+
+
+def test_loop_jitter():
+    clock, ticker = make_ticker()
+    ticker.jitter = True
+    phases = set(ticker.add_loop(20, lambda: None).phase for _ in range(100))
+    assert len(phases) > 1
+    assert all(0 <= phase < 20 for phase in phases)
+
+
+def test_tick_budget():
+    clock, ticker = make_ticker()
+    ticker.scheduler.tick_budget = 0
+    ticks = []
+    ticker.add_loop(4, lambda: ticks.append(("low", ticker.tick)),
+                    priority=PRIORITY_LOW)
+    ticker.add_loop(1, lambda: time.sleep(0.001), priority=PRIORITY_HIGH)
+    ticker.start()
+    run(clock, 9)
+
+    # Deferred until one tick before the next run is due, then run anyway
+    assert ticks == [("low", 3), ("low", 7)]
+
+
+def test_delay_restart_stop():
+    clock, ticker = make_ticker()
+    fired = []
+    ticker.start()
+    delay = ticker.add_delay(10, lambda: fired.append(ticker.tick))
+    run(clock, 8)
+    delay.restart()
+    run(clock, 8)
+    assert fired == []
+    run(clock, 5)
+    assert fired == [18]
+    assert ticker._tasks == {}
+
+    delay = ticker.add_delay(3, lambda: fired.append(ticker.tick))
+    delay.stop()
+    run(clock, 5)
+    assert fired == [18]
+
+
+def test_long_delay():
+    clock, ticker = make_ticker()
+    fired = []
+    ticker.start()
+    ticker.add_delay(1000, lambda: fired.append(ticker.tick))
+    ticker.add_loop(300, lambda: fired.append(ticker.tick))
+    run(clock, 1001)
+    assert fired == [0, 300, 600, 900, 1000]
+
+
+def test_shared_scheduler():
+    clock = Clock()
+    scheduler = DummyScheduler(clock)
+    ticker1 = Ticker(logger, scheduler)
+    ticker2 = Ticker(logger, scheduler)
+    fired = []
+    ticker1.add_delay(3, lambda: fired.append(1))
+    ticker1.start()
+    run(clock, 2)
+    ticker2.add_delay(3, lambda: fired.append(2))
+    ticker2.start()
+    run(clock, 2)
+    assert fired == [1]
+    ticker1.stop()
+    assert scheduler.running
+    ticker2.stop()
+    assert not scheduler.running
+    assert fired == [1]
+
+
+def test_stop_resume():
+    clock, ticker = make_ticker()
+    fired = []
+    ticker.add_delay(4, lambda: fired.append(ticker.tick))
+    ticker.start()
+    run(clock, 2)
+    ticker.stop()
+    run(clock, 10)
+    assert fired == []
+    ticker.start()
+    run(clock, 3)
+    assert fired == [4]
+
+
+def test_skip_ticks():
+    clock, ticker = make_ticker()
+    ticks = []
+    ticker.add_loop(1, lambda: ticks.append(ticker.tick))
+    ticker.start()
+    clock.advance(DummyScheduler.interval * 100)
+    assert ticks == [0]
+    assert ticker.scheduler.stats.skipped == 99
+    run(clock, 1)
+    assert ticks == [0, 1]
+    assert len(ticker.scheduler.stats.durations) == 2
+
+
+def test_stats_percentiles():
+    stats = TickStats()
+    for ms in range(1, 101):
+        stats.record_tick(ms / 1000.0)
+    assert round(stats.get_mspt(), 6) == 50.5
+    assert round(stats.get_mspt(95), 6) == 95
+    assert stats.get_percentiles((0, 100)) == {0: 1, 100: 100}
+
+
+class Dummy(object):
+    def update(self):
+        pass
+
+
+def test_stats_tasks():
+    clock = Clock()
+    scheduler = DummyScheduler(clock)
+    parent = TickStats()
+    tickers = [Ticker(logger, scheduler) for _ in range(2)]
+    for ticker in tickers:
+        ticker.stats.parent = parent
+        ticker.add_loop(1, Dummy().update)
+        ticker.add_loop(2, lambda: None)
+        ticker.start()
+    run(clock, 4)
+
+    costs = tickers[0].stats.get_task_costs()
+    assert sorted(name for name, calls, cost in costs) == [
+        "Dummy.update", "test_stats_tasks.<locals>.<lambda>"]
+    assert dict((name, calls) for name, calls, cost in costs) == {
+        "Dummy.update": 4, "test_stats_tasks.<locals>.<lambda>": 2}
+    assert len(tickers[0].stats.durations) == 0
+    assert parent.tasks["Dummy.update"][0] == 8
+    assert len(parent.durations) == 3
+
+
+def test_stats_window_size():
+    clock = Clock()
+    scheduler = DummyScheduler(clock)
+    ticker_type = type("WindowTicker", (Ticker,), {"stats_window_size": 2})
+    ticker = ticker_type(logger, scheduler)
+    ticker.add_loop(1, lambda: None)
+    ticker.start()
+    run(clock, 4)
+    assert len(ticker.stats.durations) == 2
+    assert ticker.stats.ticks == 3
+
+
+def test_virtual_ticker():
+    ticker_type = VirtualTicker.with_clock()
+    ticker = ticker_type(logger)
+    ticks = []
+    ticker.add_loop(20, lambda: ticks.append(ticker.tick))
+    ticker.start()
+    ticker_type.advance(72000)
+    assert len(ticks) == 3600
+    assert ticker.tick == 72000
+    assert round(ticker_type.clock.seconds()) == 3600
+
+
+def test_virtual_ticker_factory():
+    class DummyProtocol(Protocol):
+        timed_out = False
+
+        def connection_timed_out(self):
+            self.timed_out = True
+
+    class DummyFactory(Factory):
+        protocol = DummyProtocol
+        ticker_type = VirtualTicker.with_clock()
+
+    factory = DummyFactory()
+    protocol = factory.buildProtocol(IPv4Address("TCP", "127.0.0.1", 25565))
+    factory.ticker_type.advance(600)
+    assert not protocol.timed_out
+    factory.ticker_type.advance(1)
+    assert protocol.timed_out
+    protocol.ticker.stop()
+
+
+def test_timer():
+    ticker_type = VirtualTicker.with_clock()
+    fired = []
+    timer = ticker_type.add_timer(10, lambda: fired.append(True))
+    ticker_type.advance(5)
+    timer.restart()
+    ticker_type.advance(10)
+    assert not fired
+    ticker_type.advance(1)
+    assert fired == [True]
+    timer.stop()
+
+    timer = ticker_type.add_timer(10, lambda: fired.append(False))
+    timer.stop()
+    ticker_type.advance(20)
+    assert fired == [True]
+    assert not get_scheduler(ticker_type.clock).running
+
+
+def test_virtual_scheduler_released():
+    clock = Clock()
+    scheduler = get_scheduler(clock)
+    assert get_scheduler(clock) is scheduler
+    ref = weakref.ref(clock)
+    del clock, scheduler
+    gc.collect()
+    assert ref() is None
+
+
+def test_ticker_interval():
+    clock = Clock()
+    fast_type = VirtualTicker.with_clock(clock)
+    slow_type = type("SlowTicker", (fast_type,), {"interval": 1.0/10})
+    fast, slow = fast_type(logger), slow_type(logger)
+    assert fast.scheduler is not slow.scheduler
+    assert slow.scheduler.interval == 1.0/10
+    fast.start()
+    slow.start()
+    for _ in range(10):
+        clock.advance(0.1)
+    assert (fast.tick, slow.tick) == (20, 10)
+    fast.stop()
+    slow.stop()
+
+
+def test_set_tick():
+    clock, ticker = make_ticker()
+    ticks = []
+    ticker.add_delay(10, lambda: ticks.append(ticker.tick))
+    ticker.start()
+    run(clock, 3)
+    ticker.tick = 100
+    assert ticker.tick == 100
+    run(clock, 1)
+    assert ticks == [100]
+    ticker.stop()
+    ticker.tick = 5
+    assert ticker.tick == 5
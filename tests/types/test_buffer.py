@@ -1,8 +1,9 @@
 from collections import OrderedDict
+import zlib
 
 import pytest
 
-from quarry.types.buffer import Buffer, BufferUnderrun
+from quarry.types.buffer import Buffer, BufferUnderrun, BufferLimitExceeded
 from quarry.types.chat import Message
 from quarry.types.nbt import *
 from quarry.types.uuid import UUID
@@ -40,6 +41,15 @@ varint_vectors = [
     (2147483647, b"\xFF\xFF\xFF\xFF\x07"),
     (-2147483648, b"\x80\x80\x80\x80\x08"),
 ]
+varlong_vectors = [
+    (0, b"\x00"),
+    (2147483647, b"\xFF\xFF\xFF\xFF\x07"),
+    (2147483648, b"\x80\x80\x80\x80\x08"),
+    (9223372036854775807, b"\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\x7F"),
+    (-1, b"\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\x01"),
+    (-2147483648, b"\x80\x80\x80\x80\xF8\xFF\xFF\xFF\xFF\x01"),
+    (-9223372036854775808, b"\x80\x80\x80\x80\x80\x80\x80\x80\x80\x01"),
+]
 slot_vectors = [
     # Empty slot
     ({'item': None}, b'\x00'),
@@ -163,6 +173,28 @@ def test_unpack_varint():
         assert buffer.unpack_varint() == value
         assert len(buffer) == 0
 
+def test_unpack_varint_underrun():
+    buffer = Buffer()
+    buffer.add(b"\xAC")
+    with pytest.raises(BufferUnderrun):
+        buffer.unpack_varint()
+    buffer.add(b"\x02")
+    assert buffer.unpack_varint() == 300
+
+def test_unpack_varint_array():
+    buffer = Buffer()
+    buffer.add(b"".join(data for value, data in varint_vectors))
+    assert buffer.unpack_varint_array(len(varint_vectors)) == \
+        [value for value, data in varint_vectors]
+    assert len(buffer) == 0
+
+def test_unpack_varlong():
+    buffer = Buffer()
+    for value, data in varlong_vectors:
+        buffer.add(data)
+        assert buffer.unpack_varlong() == value
+        assert len(buffer) == 0
+
 def test_unpack_uuid():
     buffer = Buffer()
     buffer.add(uuid_vector)
@@ -201,6 +233,21 @@ def test_pack_varint():
     for value, data in varint_vectors:
         assert Buffer.pack_varint(value) == data
 
+def test_pack_varint_array():
+    assert Buffer.pack_varint_array(
+        [value for value, data in varint_vectors]) == \
+        b"".join(data for value, data in varint_vectors)
+
+def test_pack_varint_range():
+    with pytest.raises(ValueError):
+        Buffer.pack_varint(2147483648)
+    with pytest.raises(ValueError):
+        Buffer.pack_varint(200, max_bits=8)
+
+def test_pack_varlong():
+    for value, data in varlong_vectors:
+        assert Buffer.pack_varlong(value) == data
+
 def test_pack_uuid():
     assert Buffer.pack_uuid(UUID.from_bytes(uuid_vector)) == uuid_vector
 
@@ -210,4 +257,105 @@ def test_pack_slot():
 
 def test_pack_entity_metadata():
     for value, data in entity_metadata_vectors:
-        assert Buffer.pack_entity_metadata(value) == data
\ No newline at end of file
+        assert Buffer.pack_entity_metadata(value) == data
+
+def test_save_compaction():
+    buffer = Buffer()
+    buffer.compact_threshold = 4
+    buffer.add(b"spameggs")
+    assert buffer.read(4) == b"spam"
+    buffer.save()
+    assert len(buffer) == 4
+    assert buffer.read(2) == b"eg"
+    buffer.restore()
+    assert buffer.read() == b"eggs"
+    buffer.add(b"ham")
+    buffer.save()
+    buffer.add(b"spam")
+    assert buffer.read(3) == b"ham"
+    buffer.restore()
+    assert buffer.read() == b"hamspam"
+    assert isinstance(buffer.read(0), bytes)
+
+def test_unpack_packet_burst():
+    packet = Buffer.pack_packet(b"\x00spam")
+    buffer = Buffer()
+    buffer.add(packet * 100)
+    for _ in range(100):
+        buffer.save()
+        assert buffer.unpack_packet(Buffer).read() == b"\x00spam"
+    buffer.save()
+    assert len(buffer) == 0
+
+def test_unpack_packet_lazy():
+    body = b"\x21" + bytes(range(256)) * 64
+    packet = Buffer.pack_packet(body, compression_threshold=256)
+
+    buffer = Buffer(packet)
+    buff = buffer.unpack_packet(Buffer, 256, lazy=True)
+    assert len(buff) == len(body)
+    assert buff.unpack_varint() == 0x21
+    assert buff.read(3) == b"\x00\x01\x02"
+    assert buff.read() == body[4:]
+    assert len(buff) == 0
+
+    buffer = Buffer(packet)
+    buff = buffer.unpack_packet(Buffer, 256, lazy=True)
+    assert buff.unpack_varint() == 0x21
+    buff.discard()
+    assert len(buff) == 0
+
+    packet = Buffer.pack_packet(b"\x21\xAC\x02" * 100, compression_threshold=0)
+    buff = Buffer(packet).unpack_packet(Buffer, 0, lazy=True)
+    assert buff.unpack_varint_array(200) == [0x21, 300] * 100
+
+def test_unpack_packet_limits():
+    body = b"\x21" + bytes(1000)
+    packet = Buffer.pack_packet(body, compression_threshold=256)
+
+    buffer = Buffer(packet)
+    buffer.max_frame_size = 10
+    with pytest.raises(BufferLimitExceeded):
+        buffer.unpack_packet(Buffer, 256)
+
+    for lazy in (False, True):
+        buffer = Buffer(packet)
+        buffer.max_uncompressed_size = 1000
+        with pytest.raises(BufferLimitExceeded):
+            buffer.unpack_packet(Buffer, 256, lazy)
+
+    # Declared length is shorter than the real body
+    bad_packet = Buffer.pack_packet(
+        Buffer.pack_varint(500) + zlib.compress(body))
+    with pytest.raises(BufferLimitExceeded):
+        Buffer(bad_packet).unpack_packet(Buffer, 256)
+    buff = Buffer(bad_packet).unpack_packet(Buffer, 256, lazy=True)
+    with pytest.raises(BufferLimitExceeded):
+        buff.read()
+
+def test_unpack_array_limits():
+    buffer = Buffer(Buffer.pack_packet(b"\x03\x01\x02\x03"))
+    buffer.max_array_length = 2
+    buff = buffer.unpack_packet(Buffer)
+    assert buff.max_array_length == 2
+    with pytest.raises(BufferLimitExceeded):
+        buff.unpack_varint_array(buff.unpack_varint())
+    with pytest.raises(BufferLimitExceeded):
+        buff.unpack_array("b", 3)
+    buff.max_array_length = 3
+    assert buff.unpack_array("b", 3) == [1, 2, 3]
+
+    buff = Buffer(b"\x0a\x00\x00\x00\x03\x00\x00\x00")
+    buff.max_array_length = 2
+    with pytest.raises(BufferLimitExceeded):
+        TagList.from_buff(buff)
+
+def test_pack_packet_compression_level():
+    body = bytes(range(256)) * 16
+    for level, strategy in ((0, zlib.Z_DEFAULT_STRATEGY),
+                            (9, zlib.Z_DEFAULT_STRATEGY),
+                            (6, zlib.Z_FILTERED)):
+        packet = Buffer.pack_packet(body, 256, level, strategy)
+        buff = Buffer(packet).unpack_packet(Buffer, 256)
+        assert buff.read() == body
+    assert len(Buffer.pack_packet(body, 256, 0)) > len(body)
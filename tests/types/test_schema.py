@@ -0,0 +1,66 @@
+import pytest
+
+from quarry.data.schemas import get_schema
+from quarry.types.buffer import Buffer, Buffer1_7, BufferUnderrun
+from quarry.types.schema import Schema
+
+handshake_vector = b"\xf8\x05\x09localhost\x63\xdd\x02"
+
+
+def test_compile_unpack():
+    packet_type = get_schema(760, "upstream", "handshake").compile(Buffer)
+    packet = packet_type.from_buff(Buffer(handshake_vector))
+    assert packet.protocol_version == 760
+    assert packet.connect_host == "localhost"
+    assert packet.connect_port == 25565
+    assert packet.protocol_mode == 2
+
+
+def test_compile_pack():
+    packet_type = get_schema(760, "upstream", "handshake").compile(Buffer)
+    packet = packet_type(protocol_version=760, connect_host="localhost",
+                         connect_port=25565, protocol_mode=2)
+    assert packet.to_bytes() == handshake_vector
+    assert packet == packet_type.from_buff(Buffer(handshake_vector))
+
+
+def test_compile_cached():
+    schema = Schema("spam", [("eggs", "i")])
+    assert schema.compile(Buffer) is schema.compile(Buffer)
+    assert schema.compile(Buffer) is not schema.compile(Buffer1_7)
+
+
+def test_merge_fixed_fields():
+    schema = Schema("spam", [
+        ("a", "d"), ("b", "f"), ("c", "?"), ("d", "varint"), ("e", "B")])
+    packet_type = schema.compile(Buffer)
+    data = Buffer.pack("df?", 1.5, 2.5, True) + b"\xac\x02" + b"\x07"
+    packet = packet_type.from_buff(Buffer(data))
+    assert (packet.a, packet.b, packet.c, packet.d, packet.e) == \
+        (1.5, 2.5, True, 300, 7)
+    assert packet.to_bytes() == data
+    assert not hasattr(packet, "__dict__")
+
+
+def test_underrun():
+    packet_type = Schema("spam", [("a", "q")]).compile(Buffer)
+    with pytest.raises(BufferUnderrun):
+        packet_type.from_buff(Buffer(b"\x00\x00"))
+
+
+def test_version_selection():
+    assert get_schema(5, "downstream", "keep_alive").fields == \
+        (("keep_alive_id", "i"),)
+    assert get_schema(338, "downstream", "keep_alive").fields == \
+        (("keep_alive_id", "varint"),)
+    assert get_schema(340, "downstream", "keep_alive").fields == \
+        (("keep_alive_id", "q"),)
+    with pytest.raises(KeyError):
+        get_schema(5, "upstream", "teleport_confirm")
+
+
+def test_invalid_schema():
+    with pytest.raises(ValueError):
+        Schema("spam", [("class", "i")])
+    with pytest.raises(ValueError):
+        Schema("spam", [("eggs", "ham")])